@@ -0,0 +1,433 @@
+# benchmark.py -
+#   performance benchmarks for spiro components. these do not need any spiro
+#   hardware, and may be run on- or off-device:
+#
+#     python3 -m spiro.benchmark encoders [--image FILE]
+#     python3 -m spiro.benchmark memory
+#     python3 -m spiro.benchmark motion
+#     python3 -m spiro.benchmark steprate
+#     python3 -m spiro.benchmark log
+#     python3 -m spiro.benchmark liveview
+#     python3 -m spiro.benchmark zip
+#
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+
+
+def syntheticFrame(res=(3280, 2464), seed=0):
+    '''returns a raw RGB frame with smooth gradients and sensor-like noise, which
+       compresses roughly like a real plate image. returns (data, raw_res, res).'''
+    rng = np.random.default_rng(seed)
+    w, h = res
+    y, x = np.mgrid[0:h, 0:w]
+    base = (96 + 64 * np.sin(x / 200.0) * np.cos(y / 150.0)).astype(np.int16)
+    frame = np.empty((h, w, 3), dtype=np.uint8)
+    for c in range(3):
+        noise = rng.normal(0, 4, size=(h, w)).astype(np.int16)
+        frame[:, :, c] = np.clip(base + 20 * c + noise, 0, 255)
+    return frame.tobytes(), res, res
+
+
+def loadFrame(path):
+    '''loads an existing image as a raw frame'''
+    from PIL import Image
+    with Image.open(path) as im:
+        im = im.convert('RGB')
+        return im.tobytes(), im.size, im.size
+
+
+def encoders(args):
+    from spiro.encoder import Encoder, formats, extension
+    if args.image:
+        data, raw_res, res = loadFrame(args.image)
+    else:
+        data, raw_res, res = syntheticFrame()
+    levels = [int(l) for l in args.levels.split(',')]
+    enc = Encoder(1, raw_res)
+    enc.buffers.arrays[0].reshape(-1)[:] = np.frombuffer(data, dtype=np.uint8)
+
+    print("Frame size: %dx%d, %d images per setting" % (res[0], res[1], args.count))
+    print("%-8s %6s %10s %14s" % ('format', 'level', 's/image', 'bytes/image'))
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fmt in formats:
+                for level in (levels if fmt != 'tiff' else [0]):
+                    filename = os.path.join(tmpdir, 'bench' + extension(fmt))
+                    times = []
+                    sizes = []
+                    for i in range(args.count):
+                        preview, size, steps, crc = enc.encode(0, res, filename, fmt, level)
+                        times.append(steps['encode'] + steps['write'])
+                        sizes.append(size)
+                    print("%-8s %6s %10.2f %14d" % (fmt, level if fmt != 'tiff' else '-',
+                                                   sum(times) / len(times), sum(sizes) // len(sizes)))
+    finally:
+        enc.shutdown()
+
+
+def copyingCapture(data, raw_res, res):
+    '''the capture path used before frame buffers were introduced'''
+    from io import BytesIO
+    from PIL import Image
+    stream = BytesIO()
+    stream.write(data)
+    stream.seek(0)
+    im = Image.frombytes('RGB', raw_res, stream.read()).crop(box=(0,0)+tuple(res))
+    im.close()
+
+
+def bufferedCapture(data, raw_res, res, buffers):
+    '''captures into a reused frame buffer, and decodes the cropped view in place'''
+    from PIL import Image
+    index = buffers.acquire()
+    frame = buffers.arrays[index]
+    frame.reshape(-1)[:] = np.frombuffer(data, dtype=np.uint8)
+    im = Image.frombuffer('RGB', tuple(res), frame, 'raw', 'RGB', frame.strides[0], 1)
+    im.close()
+    buffers.release(index)
+
+
+def measureCycles(conn, capture, cycles):
+    '''runs in a forked child, and reports its peak RSS increase over a number of 4-plate cycles'''
+    from spiro.experimenter import peakRSS
+    base = peakRSS()
+    peaks = []
+    for i in range(cycles):
+        for plate in range(4):
+            capture()
+        peaks.append(peakRSS() - base)
+    conn.send(peaks)
+    conn.close()
+
+
+def memory(args):
+    import multiprocessing
+    from spiro.encoder import FrameBuffers
+    raw = (3296, 2464)
+    res = (3280, 2464)
+    data, _, _ = syntheticFrame(raw)
+    buffers = FrameBuffers(raw, 3)
+    paths = [('copying', lambda: copyingCapture(data, raw, res)),
+             ('buffered', lambda: bufferedCapture(data, raw, res, buffers))]
+
+    ctx = multiprocessing.get_context('fork')
+    print("%-10s %s" % ('capture', 'peak RSS increase per cycle (MB)'))
+    for name, capture in paths:
+        parent, child = ctx.Pipe()
+        p = ctx.Process(target=measureCycles, args=(child, capture, args.cycles))
+        p.start()
+        peaks = parent.recv()
+        p.join()
+        print("%-10s %s" % (name, ' '.join('%.1f' % peak for peak in peaks)))
+
+
+def backgroundLoad(stop):
+    '''keeps a thread busy with the kind of work the web server and encoder do, until stop is set'''
+    import io
+    from PIL import Image
+    im = Image.frombytes('RGB', (640, 480), syntheticFrame((640, 480))[0])
+    while not stop.is_set():
+        # pure python work holds the GIL, png encoding mostly releases it
+        sum(i * i for i in range(20000))
+        im.save(io.BytesIO(), format='png', compress_level=6)
+
+
+def motion(args):
+    import threading
+    from spiro.fakegpio import FakeGPIO
+    from spiro.hwcontrol import HWControl
+    from spiro.motion import profiles, stepDelays
+    fake = FakeGPIO()
+    hw = HWControl(backend=fake)
+    stop = threading.Event()
+    for i in range(args.load):
+        threading.Thread(target=backgroundLoad, args=(stop,), daemon=True).start()
+
+    print("%-12s %6s %8s %10s %12s %14s" % ('profile', 'steps', 'time (s)', 'peak (s/s)', 'max accel', 'timing error'))
+    for name in ['fixed 0.03 s'] + profiles:
+        for steps in [int(s) for s in args.steps.split(',')]:
+            fake.reset()
+            if name == 'fixed 0.03 s':
+                hw.halfStep(steps, 0.03)
+                planned = (0.03,) * steps
+            else:
+                startspeed, maxspeed, accel = hw.motion[:3]
+                planned = stepDelays(steps, startspeed, maxspeed, accel, profile=name)
+                hw.move(steps, delays=planned)
+            intervals = fake.intervals()
+            speeds = [1 / t for t in intervals]
+            accel = max([abs(b - a) / t for a, b, t in zip(speeds, speeds[1:], intervals[1:])] or [0])
+            error = max([abs(a - b) for a, b in zip(intervals, planned)] or [0])
+            print("%-12s %6d %8.2f %10.1f %12.1f %12.2f ms" % (name, steps, fake.steps[-1] - fake.steps[0] + planned[-1],
+                                                             max(speeds), accel, error * 1000))
+    stop.set()
+
+    jitter = hw.jitter.summary()
+    print("\nstep jitter: mean %.3f ms, max %.3f ms over %d steps" % (jitter['mean'] * 1000, jitter['max'] * 1000, jitter['count']))
+    for bound, count in jitter['buckets']:
+        print("  %12s %6d" % ('<= %.2f ms' % (bound * 1000) if bound is not None else '> %.2f ms' % (hw.jitter.buckets[-1] * 1000), count))
+
+
+def perPinSteps(gpio, pins, states, steps):
+    '''steps the motor with one write per coil pin, as the motor code used to'''
+    for i in range(steps):
+        state = states[i % 8]
+        gpio.output(pins[0], state[0])
+        gpio.output(pins[1], state[1])
+        gpio.output(pins[2], state[2])
+        gpio.output(pins[3], state[3])
+
+
+def batchedSteps(gpio, pins, states, steps):
+    '''steps the motor with one multi-channel write per step'''
+    output = gpio.output
+    for i in range(steps):
+        output(pins, states[i % 8])
+
+
+def coilSkew(writes, pins):
+    '''returns the times between the first and last coil update of each step'''
+    coil = [t for t, pin, v in writes if pin in pins]
+    return [coil[i + 3] - coil[i] for i in range(0, len(coil) - 3, 4)]
+
+
+def steprate(args):
+    import time
+    from spiro.fakegpio import FakeGPIO
+    from spiro.hwcontrol import HWControl
+    fake = FakeGPIO()
+    hw = HWControl(backend=fake)
+    pins, states = hw.coilpins, hw.coil_states
+    print("the stand-in backend records all pins of a multi-channel write at the same time; on")
+    print("RPi.GPIO, the pins of a list are written back to back from C.\n")
+
+    print("%-20s %12s %16s %15s" % ('method', 'steps/s', 'mean skew (us)', 'max skew (us)'))
+    for name, run in [('per-pin writes', perPinSteps), ('batched writes', batchedSteps),
+                      ('HWControl.move', lambda gpio, pins, states, steps: hw.move(steps, delays=(0,) * steps))]:
+        fake.reset()
+        start = time.perf_counter()
+        run(fake, pins, states, args.steps)
+        elapsed = time.perf_counter() - start
+        skew = coilSkew(fake.writes, pins)
+        print("%-20s %12.0f %16.2f %15.2f" % (name, args.steps / elapsed, sum(skew) / len(skew) * 1e6, max(skew) * 1e6))
+
+
+def cpuTime():
+    '''returns the cpu time used by this process and its waited-for children'''
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def logview(args):
+    import time
+    import subprocess
+    from flask import Flask, request
+    from spiro import logger, logview
+    for i in range(args.records):
+        logger.log("Benchmark record %d with some typical message text." % i)
+    logger.flush()
+    app = Flask(__name__)
+    app.add_url_rule('/log', 'log', lambda: logview.response(request))
+    client = app.test_client()
+
+    def journal():
+        p = subprocess.Popen(['/bin/journalctl', '--user-unit=spiro', '-n', '1000'], stdout=subprocess.PIPE)
+        p.stdout.read()
+        p.wait()
+
+    tests = [('ring buffer', lambda: client.get('/log').get_data())]
+    if os.path.exists('/bin/journalctl'):
+        tests.append(('journalctl', journal))
+    else:
+        print("/bin/journalctl not found, not measuring the journal.")
+    print("%-12s %14s %14s" % ('source', 'latency (ms)', 'cpu time (ms)'))
+    for name, get in tests:
+        start, cpu = time.perf_counter(), cpuTime()
+        for i in range(args.count):
+            get()
+        print("%-12s %14.2f %14.2f" % (name, (time.perf_counter() - start) / args.count * 1000,
+                                      (cpuTime() - cpu) / args.count * 1000))
+
+
+class CopyingOutput(object):
+    '''the live view output as it used to be, copying each frame out of a reused BytesIO'''
+    def __init__(self):
+        import io
+        self.frame = None
+        self.buffer = io.BytesIO()
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8'):
+            self.buffer.truncate()
+            self.frame = self.buffer.getvalue()
+            self.buffer.seek(0)
+        return self.buffer.write(buf)
+
+
+def syntheticJPEGs(count=8, res=(1024, 768)):
+    '''returns a few jpeg frames of slightly different sizes, like a live view stream'''
+    import io
+    from PIL import Image
+    data, raw_res, res = syntheticFrame(res)
+    frames = []
+    for i in range(count):
+        out = io.BytesIO()
+        Image.frombytes('RGB', res, data).save(out, format='jpeg', quality=75 + i)
+        frames.append(out.getvalue())
+    return frames
+
+
+def cameraWrites(output, frames, n):
+    '''writes n frames to output in chunks, as the camera does'''
+    for i in range(n):
+        for chunk in frames[i % len(frames)]:
+            output.write(chunk)
+
+
+def liveview(args):
+    import time
+    import tracemalloc
+    from spiro.broadcast import FrameStore
+    jpegs = syntheticJPEGs()
+    print("synthetic frames: %d to %d bytes, %d clients\n" % (min(map(len, jpegs)), max(map(len, jpegs)), args.clients))
+    # the camera hands over each frame in buffers of up to 64 kB
+    frames = [[jpeg[i:i + 65536] for i in range(0, len(jpeg), 65536)] for jpeg in jpegs]
+
+    def copying():
+        output = CopyingOutput()
+        def read():
+            if output.frame:
+                for c in range(args.clients):
+                    b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + output.frame + b'\r\n'
+        return output, read
+
+    def ring():
+        output = FrameStore()
+        def read():
+            frame = output.acquire(timeout=0) if output.latest else None
+            if frame:
+                for c in range(args.clients):
+                    frame.chunk()
+                output.release(frame)
+        return output, read
+
+    print("%-10s %14s %22s %22s" % ('output', 'us per frame', 'peak new kB, camera', 'peak new kB, clients'))
+    for name, setup in [('copying', copying), ('ring', ring)]:
+        output, read = setup()
+        cameraWrites(output, frames, 10)
+        start = time.perf_counter()
+        for i in range(args.frames):
+            cameraWrites(output, frames, 1)
+            read()
+        elapsed = (time.perf_counter() - start) / args.frames
+
+        # the peak of new allocations while storing one frame, and while the clients read it
+        tracemalloc.start()
+        writes, reads = [], []
+        for i in range(50):
+            for step, peaks in [(lambda: cameraWrites(output, frames, 1), writes), (read, reads)]:
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                step()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+        print("%-10s %14.1f %22.1f %22.1f" % (name, elapsed * 1e6, sum(writes) / len(writes) / 1024, sum(reads) / len(reads) / 1024))
+
+
+def zipExport(args):
+    import time
+    import zlib
+    import subprocess
+    from spiro import zipstream
+    with tempfile.TemporaryDirectory() as tmpdir:
+        expdir = os.path.join(tmpdir, 'experiment')
+        crcs = {}
+        for p in range(4):
+            os.makedirs(os.path.join(expdir, 'plate%d' % (p + 1)))
+            for i in range(args.files // 4):
+                path = os.path.join(expdir, 'plate%d' % (p + 1), 'image%05d.png' % i)
+                data = os.urandom(args.size * 1024)
+                crcs[path] = zlib.crc32(data)
+                with open(path, 'wb') as f:
+                    f.write(data)
+        total = sum(os.path.getsize(p) for p in crcs)
+        print("%d files, %.0f MB, read from the page cache\n" % (len(crcs), total / 1024**2))
+
+        def external():
+            p = subprocess.Popen(['/usr/bin/zip', '-q', '-r', '-0', '-', 'experiment'], stdout=subprocess.PIPE, cwd=tmpdir)
+            n = 0
+            data = p.stdout.read(128*1024)
+            while data:
+                n += len(data)
+                data = p.stdout.read(128*1024)
+            p.wait()
+            return n
+
+        def streamed(known):
+            entries = [zipstream.Entry(p, os.path.relpath(p, tmpdir), crcs[p] if known else None) for p in sorted(crcs)]
+            return sum(len(data) for data in zipstream.ZipStream(entries))
+
+        print("%-24s %10s %10s" % ('writer', 'MB/s', 'cpu s'))
+        tests = [('streamed, crc known', lambda: streamed(True)), ('streamed, crc computed', lambda: streamed(False))]
+        if os.path.exists('/usr/bin/zip'):
+            tests.append(('/usr/bin/zip -0', external))
+        for name, run in tests:
+            run()
+            start = time.perf_counter()
+            cpu = os.times()
+            n = run()
+            elapsed = time.perf_counter() - start
+            cpu = sum(os.times()[:4]) - sum(cpu[:4])
+            print("%-24s %10.0f %10.2f" % (name, n / elapsed / 1024**2, cpu))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SPIRO performance benchmarks.")
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('encoders', help="seconds and bytes per image for each output format")
+    p.add_argument('--image', help="use this image instead of a synthetic 3280x2464 frame")
+    p.add_argument('--count', type=int, default=3, help="images to encode per setting")
+    p.add_argument('--levels', default='1,6,9', help="comma-separated compression levels to test")
+    p.set_defaults(func=encoders)
+
+    p = sub.add_parser('memory', help="peak RSS per cycle for the copying and buffered capture paths")
+    p.add_argument('--cycles', type=int, default=3, help="number of 4-plate cycles to run")
+    p.set_defaults(func=memory)
+
+    p = sub.add_parser('motion', help="duration and timing of stepper moves, using a stand-in gpio backend")
+    p.add_argument('--steps', default='50,100,200', help="comma-separated move lengths, in half steps")
+    p.add_argument('--load', type=int, default=0, help="number of busy background threads to run during the moves")
+    p.set_defaults(func=motion)
+
+    p = sub.add_parser('steprate', help="achievable steps per second and coil update skew, using a stand-in gpio backend")
+    p.add_argument('--steps', type=int, default=20000, help="number of half steps to take")
+    p.set_defaults(func=steprate)
+
+    p = sub.add_parser('log', help="latency and cpu time of log page requests, from the log buffer and the journal")
+    p.add_argument('--records', type=int, default=1000, help="number of records to log first")
+    p.add_argument('--count', type=int, default=20, help="number of requests per source")
+    p.set_defaults(func=logview)
+
+    p = sub.add_parser('liveview', help="time and memory allocated per live view frame, using a stand-in camera")
+    p.add_argument('--frames', type=int, default=500, help="number of frames to write")
+    p.add_argument('--clients', type=int, default=3, help="number of clients reading each frame")
+    p.set_defaults(func=liveview)
+
+    p = sub.add_parser('zip', help="throughput of experiment zip exports, compared with the zip program")
+    p.add_argument('--files', type=int, default=200, help="number of files in the experiment")
+    p.add_argument('--size', type=int, default=2048, help="size of each file, in kB")
+    p.set_defaults(func=zipExport)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# broadcast.py -
+#   fan-out of live view frames to mjpeg clients
+#
+
+import time
+import threading
+from collections import deque
+from spiro.logger import debug
+
+
+class Frame(object):
+    '''a published frame. data is a memoryview into one of the buffers of the frame store,
+       which is not reused while the frame is acquired.'''
+    def __init__(self, seq, slot, data):
+        self.seq = seq
+        self.slot = slot
+        self.data = data
+        self.lock = threading.Lock()
+        self.part = None
+
+
+    def chunk(self):
+        '''returns the frame as a part of a multipart mjpeg stream. the server needs it as bytes,
+           so it is made once, by the first client that sends the frame, and shared by all.'''
+        with self.lock:
+            if self.part is None:
+                self.part = b''.join((b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(self.data),
+                                      self.data, b'\r\n'))
+            return self.part
+
+
+class FrameStore(object):
+    '''file-like output for the camera's mjpeg recording, which stores the frames in a small
+       ring of preallocated buffers instead of copying each frame into a new bytes object.
+       readers acquire the newest frame, and release it once they have sent it; buffers with
+       acquired frames are skipped when choosing the buffer for the next frame. if no buffer
+       is free, incoming frames are dropped until one is.'''
+    def __init__(self, slots=8, size=512*1024):
+        self.buffers = [memoryview(bytearray(size)) for i in range(slots)]
+        self.pins = [0] * slots
+        self.condition = threading.Condition()
+        self.latest = None
+        self.seq = 0
+        self.slot = None
+        self.length = 0
+        self.dropped = 0
+        self.grown = 0
+
+
+    def write(self, buf):
+        if buf[:2] == b'\xff\xd8':
+            # start of a new frame; publish the previous one
+            self.publish()
+            with self.condition:
+                self.slot = self.freeSlot()
+            self.length = 0
+            if self.slot is None:
+                self.dropped += 1
+        if self.slot is not None:
+            end = self.length + len(buf)
+            buffer = self.buffers[self.slot]
+            if end > len(buffer):
+                # the buffer is not published, so it can be replaced with a larger one
+                buffer = memoryview(bytearray(max(end, 2 * len(buffer))))
+                buffer[:self.length] = self.buffers[self.slot][:self.length]
+                self.buffers[self.slot] = buffer
+                self.grown += 1
+                debug("Live view frame of %d bytes, growing frame buffer to %d bytes." % (end, len(buffer)))
+            # assigning to a memoryview copies straight into the buffer, whereas assigning
+            # bytes to a bytearray slice makes a temporary copy first
+            buffer[self.length:end] = buf
+            self.length = end
+        return len(buf)
+
+
+    def flush(self):
+        pass
+
+
+    def freeSlot(self):
+        '''returns a buffer that is neither acquired by a reader nor holds the newest frame'''
+        n = len(self.buffers)
+        start = self.latest.slot if self.latest else -1
+        for i in range(1, n + 1):
+            slot = (start + i) % n
+            if self.pins[slot] == 0 and slot != start:
+                return slot
+        return None
+
+
+    def publish(self):
+        if self.slot is None or not self.length:
+            return
+        with self.condition:
+            self.seq += 1
+            self.latest = Frame(self.seq, self.slot, self.buffers[self.slot][:self.length])
+            self.condition.notify_all()
+        self.slot = None
+
+
+    def acquire(self, newer_than=0, timeout=None):
+        '''waits for a frame with a sequence number above newer_than, and returns the newest
+           frame, or None on timeout. the frame must be released after use.'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest and self.seq > newer_than, timeout):
+                return None
+            frame = self.latest
+            self.pins[frame.slot] += 1
+            return frame
+
+
+    def release(self, frame):
+        with self.condition:
+            self.pins[frame.slot] -= 1
+
+
+    def snapshot(self, timeout=2.0):
+        '''returns the newest frame as bytes, or None if there is none'''
+        frame = self.acquire(timeout=timeout)
+        if frame is None:
+            return None
+        try:
+            return frame.data.tobytes()
+        finally:
+            self.release(frame)
+
+
+class Viewer(object):
+    '''statistics for one client of the live view'''
+    def __init__(self, remote, fps):
+        self.remote = remote
+        self.fps_cap = fps
+        self.started = time.time()
+        self.sent = 0
+        # frames skipped because the client was not ready for them, and because of the fps cap
+        self.dropped = 0
+        self.capped = 0
+        # send times of the recent frames, for the delivered frame rate
+        self.times = deque(maxlen=50)
+
+
+    def fps(self):
+        '''returns the frame rate delivered over the last few seconds'''
+        now = time.monotonic()
+        recent = [t for t in self.times if now - t < 5]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1) / (now - recent[0])
+
+
+class Broadcaster(object):
+    '''shares the frames of a frame store between all mjpeg clients. each client is sent
+       the newest frame whenever it is ready for one, so frames that a slow client could
+       not keep up with are dropped rather than queued.'''
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.viewers = []
+
+
+    def stream(self, remote=None, fps=None, timeout=1.0):
+        '''generator for the mjpeg stream of one client, optionally capped at fps frames per second'''
+        viewer = Viewer(remote, fps)
+        with self.lock:
+            self.viewers.append(viewer)
+        try:
+            # start with the current frame, if there is one
+            seq = self.store.seq - 1
+            next_frame = 0
+            while True:
+                # the newest frame when the client became ready for another one; frames skipped
+                # after it were skipped while waiting for the fps cap
+                ready = self.store.seq
+                if fps:
+                    delay = next_frame - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                frame = self.store.acquire(seq, timeout)
+                if frame is None:
+                    # no new frame, but writing nothing lets the server notice a closed connection
+                    yield b''
+                    continue
+                try:
+                    chunk = frame.chunk()
+                finally:
+                    self.store.release(frame)
+                if viewer.sent:
+                    skipped = frame.seq - seq - 1
+                    dropped = min(skipped, max(0, ready - seq - (frame.seq <= ready)))
+                    viewer.dropped += dropped
+                    viewer.capped += skipped - dropped
+                seq = frame.seq
+                now = time.monotonic()
+                if fps:
+                    # keep to the average rate, unless the client has fallen more than a frame behind
+                    next_frame = now + 1.0 / fps if next_frame < now - 1.0 / fps else next_frame + 1.0 / fps
+                viewer.sent += 1
+                viewer.times.append(now)
+                # blocks while the server's output buffer for this client is full
+                yield chunk
+        finally:
+            with self.lock:
+                self.viewers.remove(viewer)
+
+
+    def stats(self):
+        '''returns a list with statistics for each connected client: frames sent, dropped because
+           the client could not keep up, and skipped because of its fps cap'''
+        with self.lock:
+            viewers = list(self.viewers)
+        return [{'remote': v.remote, 'since': v.started, 'fps': round(v.fps(), 1), 'fps_cap': v.fps_cap,
+                 'sent': v.sent, 'dropped': v.dropped, 'capped': v.capped} for v in viewers]
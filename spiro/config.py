@@ -5,6 +5,12 @@
 import json
 import os
 import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+import threading
+from collections import namedtuple
 from ._version import __version__
 
 def log(msg):
@@ -13,6 +19,8 @@ def log(msg):
 
 
 class Config(object):
+    '''access to the config values. all instances share one process-wide store, so that
+       the config file is only read when it has changed (see ConfigStore).'''
     defaults = {
         'calibration' : 8,      # number of steps taken after positional sensor is lit
         'sensor': 4,            # pin for mini microswitch positional sensor
@@ -33,58 +41,243 @@ class Config(object):
         'nightiso': 400,        # night iso
         'name': 'spiro',        # the name of this spiro instance
         'debug': False,         # debug logging
-        'rotated_camera': True  # rotated camera house
+        'rotated_camera': True, # rotated camera house
+        'imageformat': 'png',   # output format for captured images: png, tiff or webp
+        'compresslevel': 6,     # png/webp compression level, 0-9
+        'encodercores': 2,      # number of cpu cores used for image encoding
+        'daynight': 'videoport',    # day/night estimator: videoport, or threshold (the original; slower, measures every plate)
+        'daynightinterval': 0,      # seconds between day/night estimates; 0 means once per cycle
+        'daythreshold': 10,         # mean pixel intensity above which it is considered day
+        'daynighthysteresis': 2,    # margin around the threshold required for switching between day and night (videoport only)
+        'settlemode': 'adaptive',   # adaptive: wait until the stage is still in the camera view; fixed: wait 0.5 s
+        'settlethreshold': 1.5,     # mean luminance difference between frames below which the stage is still
+        'settletimeout': 2.0,       # longest time to wait for the stage to settle, in seconds
+        'overrunpolicy': 'skip',    # when a cycle overruns the interval: skip, catchup or shift (see scheduler.py)
+        'motionprofile': 'trapezoid',   # stepper acceleration profile: trapezoid, scurve or constant
+        'startspeed': 33,           # motor speed at the start and end of each move, in half steps per second
+        'maxspeed': 100,            # top motor speed, in half steps per second
+        'acceleration': 200,        # motor acceleration, in half steps per second squared
+        'homingspeed': 66,          # top motor speed while looking for the start position
+        'homingmode': 'fast',       # fast: stop at the switch; precise: back off and approach the switch again slowly
+        'homingslowspeed': 20,      # motor speed for the slow approach in precise homing mode
+        'homeinterval': 10,         # number of cycles between finding the start position in experiments
+        'positiontolerance': 4,     # allowed difference in half steps between tracked and sensed switch position
+        'thumbcachesize': 200,      # size limit of the thumbnail cache of each experiment, in MB
+        'publicmetrics': False,     # serve /metrics without login, e.g. for scraping by prometheus
     }
 
-    config = {}
-
     def __init__(self):
         self.cfgdir = os.path.expanduser("~/.config/spiro")
         self.cfgfile = os.path.join(self.cfgdir, "spiro.conf")
         self.version = __version__
-        self.read()
-        if os.path.exists(self.cfgfile):
-            st = os.stat(self.cfgfile)
-            self.mtime = st.st_mtime
-        else:
-            self.mtime = 0
+        self.store = sharedStore(self.cfgfile)
+
+
+    def get(self, key):
+        return self.store.get(key)
+
+
+    def snapshot(self):
+        '''returns an immutable snapshot of all known config values, with attribute access'''
+        return self.store.snapshot()
+
+
+    def set(self, key, value):
+        self.store.set_many({key: value})
+
+
+    def set_many(self, values):
+        '''sets several values at once, with a single write of the config file'''
+        self.store.set_many(values)
 
 
-    def read(self):
+    def unset(self, key):
+        self.store.set_many({}, unset=[key])
+
+
+    def subscribe(self, callback, keys=None):
+        '''calls callback(snapshot, changed_keys) whenever any of the given keys (or any key, if
+           keys is None) changes, whether by set() in this process or by editing the config file'''
+        self.store.subscribe(callback, keys)
+
+
+# immutable snapshot of the config values, one field per default
+Snapshot = namedtuple('Snapshot', sorted(Config.defaults))
+
+
+def coerce(key, value):
+    '''converts a config value to the type of its default, e.g. if the config file was
+       edited by hand'''
+    default = Config.defaults.get(key)
+    if default is None or value is None or type(value) is type(default):
+        return value
+    try:
+        if isinstance(default, bool) or isinstance(value, bool):
+            raise ValueError
+        return type(default)(value)
+    except (TypeError, ValueError):
+        log("Invalid value %r for config key '%s', using default." % (value, key))
+        return default
+
+
+class ConfigStore(object):
+    '''process-wide store of the config values. the config file is read once, and read again
+       when it changes on disk. changes are noticed through inotify where it is available, and
+       otherwise by checking the file at most once per check_interval seconds.'''
+    check_interval = 1.0
+
+    def __init__(self, cfgfile):
+        self.cfgfile = cfgfile
+        self.cfgdir = os.path.dirname(cfgfile)
+        self.lock = threading.RLock()
+        self.values = {}
+        self.current = Snapshot(**Config.defaults)
+        self.stamp = None
+        self.next_check = 0
+        self.subscribers = []
         os.makedirs(self.cfgdir, exist_ok=True)
-        if os.path.exists(self.cfgfile):
-            try:
-                with open(self.cfgfile, 'r') as f:
-                    self.config = json.load(f)
-            except Exception as e:
-                log("Failed to read or parse config file: " + str(e))
+        self.reload()
+        self.watched = inotifyWatch(self.cfgdir, os.path.basename(cfgfile), self.reload)
 
 
-    def write(self):
+    def fileStamp(self):
         try:
-            with open(self.cfgfile + ".tmp", 'w') as f:
-                json.dump(self.config, f, indent=4)
-            os.replace(self.cfgfile + ".tmp", self.cfgfile)
-        except OSError as e:
-            log("Failed to write config file: " + e.strerror)
+            st = os.stat(self.cfgfile)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+
+    def reload(self):
+        '''reads the config file again if it has changed since it was last read or written'''
+        with self.lock:
+            stamp = self.fileStamp()
+            if stamp == self.stamp:
+                return
+            values = {}
+            if stamp is not None:
+                try:
+                    with open(self.cfgfile, 'r') as f:
+                        values = json.load(f)
+                except Exception as e:
+                    log("Failed to read or parse config file: " + str(e))
+                    return
+            self.stamp = stamp
+            changed = self.update(values)
+        self.notify(changed)
+
+
+    def update(self, values):
+        '''replaces the values and the snapshot, and returns the keys that changed'''
+        old, old_snap = self.values, self.current
+        self.values = values
+        self.current = Snapshot(**{k: coerce(k, values.get(k, v)) for k, v in Config.defaults.items()})
+        changed = {k for k in set(old) | set(values) if old.get(k) != values.get(k)}
+        changed |= {k for k in Snapshot._fields if getattr(old_snap, k) != getattr(self.current, k)}
+        return changed
+
+
+    def check(self):
+        if not self.watched and time.monotonic() >= self.next_check:
+            self.next_check = time.monotonic() + self.check_interval
+            self.reload()
+
 
     def get(self, key):
-        if os.path.exists(self.cfgfile):
-            st = os.stat(self.cfgfile)
-            mt = st.st_mtime
-            if mt > self.mtime:
-                # config file was changed on disk -- reload it
-                self.read()
+        self.check()
+        if key in Config.defaults:
+            return getattr(self.current, key)
+        return self.values.get(key)
 
-        return self.config.get(key, self.defaults.get(key))
 
+    def snapshot(self):
+        self.check()
+        return self.current
 
-    def set(self, key, value):
-        self.config[key] = value
-        self.write()
 
+    def set_many(self, values, unset=()):
+        '''sets and unsets values, and writes the config file once, atomically'''
+        with self.lock:
+            new = dict(self.values)
+            new.update(values)
+            for key in unset:
+                new.pop(key, None)
+            if new == self.values:
+                return
+            try:
+                with open(self.cfgfile + ".tmp", 'w') as f:
+                    json.dump(new, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.cfgfile + ".tmp", self.cfgfile)
+            except OSError as e:
+                log("Failed to write config file: " + e.strerror)
+            # our own write should not trigger a reload
+            self.stamp = self.fileStamp()
+            changed = self.update(new)
+        self.notify(changed)
 
-    def unset(self, key):
-        if key in self.config:
-            del self.config[key]
-            self.write()
+
+    def subscribe(self, callback, keys=None):
+        with self.lock:
+            self.subscribers.append((callback, set(keys) if keys is not None else None))
+
+
+    def notify(self, changed):
+        if not changed:
+            return
+        snapshot = self.current
+        for callback, keys in list(self.subscribers):
+            if keys is None or keys & changed:
+                try:
+                    callback(snapshot, changed)
+                except Exception as e:
+                    log("Config change handler failed: " + str(e))
+
+
+store = None
+store_lock = threading.Lock()
+
+def sharedStore(cfgfile):
+    '''returns the process-wide config store'''
+    global store
+    with store_lock:
+        if store is None or store.cfgfile != cfgfile:
+            store = ConfigStore(cfgfile)
+        return store
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+
+def inotifyWatch(path, name, callback):
+    '''calls callback from a background thread whenever the file name in the directory path is
+       written, replaced or deleted. returns False if inotify is not available.'''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE) < 0:
+            os.close(fd)
+            return False
+    except (OSError, AttributeError):
+        return False
+
+    def watch():
+        name_b = os.fsencode(name)
+        while True:
+            data = os.read(fd, 4096)
+            i, changed = 0, False
+            while i + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+                if data[i + 16:i + 16 + length].rstrip(b'\0') == name_b:
+                    changed = True
+                i += 16 + length
+            if changed:
+                callback()
+
+    threading.Thread(target=watch, name='config-watch', daemon=True).start()
+    return True
@@ -0,0 +1,97 @@
+# daynight.py -
+#   day/night estimation strategies for experiments
+#
+
+import time
+import numpy as np
+from spiro.logger import debug
+
+
+class Estimator(object):
+    '''base class for day/night estimators. measure() returns the mean pixel intensity of
+       a low-resolution image taken with the day exposure settings. a new measurement is
+       made at most once per interval (or once per cycle, if the interval is 0), and the
+       day/night state only changes once the intensity crosses the threshold by more than
+       the hysteresis margin, so that dusk and dawn do not cause flickering.
+       estimators with per_plate set measure for every plate, without hysteresis.'''
+    per_plate = False
+
+    def __init__(self, cam, cfg):
+        self.cam = cam
+        self.cfg = cfg
+        self.threshold = cfg.get('daythreshold')
+        self.hysteresis = 0 if self.per_plate else cfg.get('daynighthysteresis')
+        self.interval = cfg.get('daynightinterval')
+        self.daytime = None
+        self.lastcheck = None
+        self.elapsed = 0
+        self.measurements = 0
+
+
+    def measure(self):
+        raise NotImplementedError
+
+
+    def update(self, newcycle=False):
+        '''returns whether it is currently daytime, measuring if one is due'''
+        now = time.monotonic()
+        if self.daytime is None or self.per_plate or (self.interval and now >= self.lastcheck + self.interval) or \
+                (not self.interval and newcycle):
+            self.lastcheck = now
+            self.cam.iso = self.cfg.get('dayiso')
+            self.cam.shutter_speed = 1000000 // self.cfg.get('dayshutter')
+            value = self.measure()
+            self.elapsed += time.monotonic() - now
+            self.measurements += 1
+            debug("Daytime estimation mean value: " + str(value))
+            if self.daytime is None:
+                self.daytime = value > self.threshold
+            elif self.daytime:
+                self.daytime = value >= self.threshold - self.hysteresis
+            else:
+                self.daytime = value > self.threshold + self.hysteresis
+        return self.daytime
+
+
+    def cycleStats(self):
+        '''returns the time spent and number of measurements since last call'''
+        stats = (self.elapsed, self.measurements)
+        self.elapsed = 0
+        self.measurements = 0
+        return stats
+
+
+class ThresholdEstimator(Estimator):
+    '''the original algorithm: switches the camera to 320x240, captures a still and
+       switches back, before every plate. the resolution changes make this slow.'''
+    per_plate = True
+
+    def measure(self):
+        oldres = self.cam.resolution
+        self.cam.resolution = (320, 240)
+        output = np.empty((240, 320, 3), dtype=np.uint8)
+        try:
+            self.cam.capture(output, 'rgb')
+        finally:
+            self.cam.resolution = oldres
+        return output.mean()
+
+
+class VideoPortEstimator(Estimator):
+    '''grabs a downscaled frame from the video port, which does not
+       require reconfiguring the camera resolution.'''
+    def measure(self):
+        output = np.empty((240, 320, 3), dtype=np.uint8)
+        self.cam.capture(output, 'rgb', use_video_port=True, resize=(320, 240))
+        return output.mean()
+
+
+estimators = {
+    'threshold': ThresholdEstimator,
+    'videoport': VideoPortEstimator,
+}
+
+
+def create(cam, cfg):
+    '''returns the estimator selected in the config'''
+    return estimators.get(cfg.get('daynight'), VideoPortEstimator)(cam, cfg)
@@ -0,0 +1,167 @@
+# encoder.py -
+#   multi-core image encoding using a pool of worker processes
+#
+
+import os
+import mmap
+import time
+import zlib
+import signal
+import queue
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+# supported output formats, and the file extension used for each
+formats = {
+    'png': '.png',
+    'tiff': '.tif',
+    'webp': '.webp',
+}
+
+
+def saveArgs(fmt, level):
+    '''returns the PIL save() arguments for the given format and compression level (0-9)'''
+    level = max(0, min(int(level), 9))
+    if fmt == 'png':
+        return {'format': 'PNG', 'compress_level': level}
+    elif fmt == 'tiff':
+        return {'format': 'TIFF', 'compression': 'raw'}
+    elif fmt == 'webp':
+        # for lossless webp, quality and method control the compression effort
+        return {'format': 'WEBP', 'lossless': True, 'quality': level * 100 // 9, 'method': level * 6 // 9}
+    raise ValueError('Unsupported image format: ' + str(fmt))
+
+
+def extension(fmt):
+    return formats.get(fmt, '.png')
+
+
+def lowerPriority():
+    '''runs in each worker process, so that encoding does not starve the web ui. also undoes the
+       signal handlers inherited from the main process, which shuts down the camera and hardware:
+       only the main process should do that. ctrl-c and hangups, which reach the whole process
+       group, are ignored, and the workers are stopped by the main process.'''
+    for sig in [signal.SIGTERM, signal.SIGQUIT, signal.SIGALRM]:
+        signal.signal(sig, signal.SIG_DFL)
+    for sig in [signal.SIGINT, signal.SIGHUP]:
+        signal.signal(sig, signal.SIG_IGN)
+    try:
+        os.nice(5)
+    except OSError:
+        pass
+
+
+# frame buffers shared with the worker processes. these are set up before the
+# pool is forked, so that the workers inherit the same shared memory mappings.
+buffers = None
+
+
+class FrameBuffers(object):
+    '''a small set of preallocated raw frame buffers in anonymous shared memory.
+       frames are captured straight into a free buffer, and the encoder reads them
+       from the same memory, so no copies are made between capture and encoding.
+       pages are only committed once a buffer is first written to, and the most
+       recently released buffer is reused first, so spare buffers stay uncommitted
+       unless the encoder falls behind.'''
+    def __init__(self, raw_res, count):
+        self.raw_res = tuple(raw_res)
+        w, h = self.raw_res
+        self.maps = [mmap.mmap(-1, w * h * 3) for i in range(count)]
+        self.arrays = [np.frombuffer(m, dtype=np.uint8).reshape((h, w, 3)) for m in self.maps]
+        self.free = queue.LifoQueue()
+        for i in range(count):
+            self.free.put(i)
+
+
+    def acquire(self):
+        '''returns the index of a free buffer, waiting for one if all are in use'''
+        return self.free.get()
+
+
+    def release(self, index):
+        self.free.put(index)
+
+
+    def view(self, index, res):
+        '''returns the cropped region of a buffer, as a view into the buffer'''
+        return self.arrays[index][:res[1], :res[0]]
+
+
+    def close(self):
+        self.arrays = []
+        for m in self.maps:
+            m.close()
+        self.maps = []
+
+
+def encodeImage(index, res, filename, fmt, level, preview_size=(800, 600)):
+    '''crops and encodes a raw RGB frame, and makes a JPEG preview of it. returns a tuple of
+       (preview bytes, file size, timings, crc32 of the file), where timings holds the seconds
+       spent on each step.'''
+    times = {}
+    start = time.perf_counter()
+    frame = buffers.arrays[index]
+    # decoding with the row stride of the raw frame skips the border, so that
+    # PIL makes its single copy of the pixels without an intermediate crop
+    im = Image.frombuffer('RGB', tuple(res), frame, 'raw', 'RGB', frame.strides[0], 1)
+    try:
+        # encode to memory first, so that the encoding and writing times can be told apart
+        data = BytesIO()
+        im.save(data, **saveArgs(fmt, level))
+        times['encode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(filename, 'wb') as f:
+            f.write(data.getbuffer())
+        size = data.tell()
+        # while the data is at hand, for the manifest and zip exports
+        crc = zlib.crc32(data.getbuffer())
+        data = None
+        times['write'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        im.thumbnail(preview_size)
+        preview = BytesIO()
+        im.save(preview, format='jpeg')
+        times['preview'] = time.perf_counter() - start
+    finally:
+        im.close()
+    return preview.getvalue(), size, times, crc
+
+
+class Encoder(object):
+    '''pool of encoder processes. the pool size is given as a core budget, which
+       should leave at least one core free for the camera and the web ui.
+       frames are passed to the pool as indices into the shared frame buffers.'''
+    def __init__(self, cores=2, raw_res=(3296, 2464)):
+        global buffers
+        self.cores = max(1, min(int(cores), os.cpu_count() or 1))
+        # one buffer per encoder process, and one for the next capture
+        self.buffers = FrameBuffers(raw_res, self.cores + 1)
+        buffers = self.buffers
+        # the pool is forked right away, as starting it later from the capture thread
+        # would copy a larger process. spawning is not an option, since the spiro
+        # entry point does not guard against being re-imported, and the workers
+        # need to inherit the frame buffers.
+        self.pool = ProcessPoolExecutor(max_workers=self.cores, initializer=lowerPriority,
+                                        mp_context=multiprocessing.get_context('fork'))
+        # a no-op job makes the pool fork all its workers now. the workers lower their own
+        # priority in the initializer, which must not run twice, as os.nice() adds up.
+        self.pool.submit(int).result()
+
+
+    def submit(self, index, res, filename, fmt='png', level=6):
+        return self.pool.submit(encodeImage, index, res, filename, fmt, level)
+
+
+    def encode(self, index, res, filename, fmt='png', level=6):
+        '''encodes a frame, blocking until it is written'''
+        return self.submit(index, res, filename, fmt, level).result()
+
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.buffers.close()
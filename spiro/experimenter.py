@@ -12,7 +12,31 @@ from datetime import date
 from statistics import mean
 from collections import deque
 from spiro.config import Config
-from spiro.logger import log, debug
+from spiro.logger import log, debug, setContext
+from spiro.imagewriter import ImageWriter, Frame
+from spiro.encoder import Encoder, extension
+import spiro.daynight as daynight
+import spiro.rawarchive as rawarchive
+import spiro.thumbs as thumbs
+import spiro.usage as usage
+from spiro.manifest import Manifest
+from spiro.scheduler import Scheduler
+from spiro.settle import SettleDetector
+from spiro.metrics import CycleTimer
+
+def peakRSS(reset=True):
+    '''returns the peak resident set size of this process in MB, optionally resetting
+       the peak so that the next call reports the peak since this one. linux only.'''
+    try:
+        with open('/proc/self/status') as f:
+            peak = next(int(l.split()[1]) for l in f if l.startswith('VmHWM:')) / 1024
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        return peak
+    except (OSError, StopIteration, ValueError):
+        return None
+
 
 class Experimenter(threading.Thread):
     def __init__(self, hw=None, cam=None):
@@ -33,9 +57,26 @@ class Experimenter(threading.Thread):
         self.next_status = ''
         self.last_captured = [''] * 4
         self.preview = [''] * 4
+        # a number for each preview, which changes with every new preview; used for http etags
+        self.preview_seq = [0] * 4
         self.preview_lock = threading.Lock()
+        self.manifest = None
         self.nshots = 0
         self.idlepos = 0
+        self.homed_cycles = 0
+        self.timer = CycleTimer()
+        self.cycle = None
+        self.rawmode = False
+        self.scheduler = None
+        self.rawcapacity = 0
+        self.estimator = None
+        self.settler = None
+        self.encoder = None
+        self.writer = None
+        # serializes setting up the encoder with starting an experiment, which uses it
+        self.encoder_lock = threading.Lock()
+        self.setupEncoder()
+        self.cfg.subscribe(self.encoderSettingsChanged, keys=['encodercores'])
         threading.Thread.__init__(self)
 
 
@@ -43,28 +84,63 @@ class Experimenter(threading.Thread):
         self.status = "Stopping"
         self.next_status = ''
         self.stop_experiment = True
+        if self.scheduler:
+            self.scheduler.stop()
         log("Stopping running experiment...")
 
 
+    def setupEncoder(self):
+        '''(re)creates the encoder pool and image writer, if the core budget has changed.
+           call with the encoder lock held, or before the experimenter thread is started.'''
+        cores = self.cfg.get('encodercores')
+        raw_res = self.rawResolution()
+        if self.encoder and self.encoder.cores == cores and self.encoder.buffers.raw_res == raw_res:
+            return
+        if self.writer:
+            self.writer.close()
+        if self.encoder:
+            self.encoder.shutdown()
+        self.encoder = Encoder(cores, raw_res)
+        # one writer thread per encoder process keeps all cores busy,
+        # and a queue slot per thread lets the next capture go ahead
+        self.writer = ImageWriter(self.saveImage, workers=self.encoder.cores, maxsize=self.encoder.cores)
+        debug("Using %d cores for image encoding." % self.encoder.cores)
+
+
+    def encoderSettingsChanged(self, cfg, changed):
+        '''sets up the encoder pool again right away, unless an experiment is running, in which
+           case the new settings are used from the next experiment'''
+        with self.encoder_lock:
+            if not self.running:
+                self.setupEncoder()
+
+
+    def rawResolution(self):
+        '''returns the size of raw RGB captures at the current camera resolution.
+           saving as 'RGB' using picamera adds a border which needs to be cropped away.
+           the raw capture size depends on the type of camera used.
+           we only support 5 MP (OV5647) and 8 MP (IMX219) cameras, for now at least.'''
+        if self.cam.resolution[0] == 3280:
+            return (3296, 2464)
+        elif self.cam.resolution[0] == 2592:
+            return (2592, 1952)
+        else:
+            # unsupported resolution, try to make the best of it
+            debug('Camera has unsupported resolution ' + str(self.cam.resolution) + '! This may lead to crashes or corrupted images.')
+            return tuple(self.cam.resolution)
+
+
     def getDefName(self):
         '''returns a default experiment name'''
         today = date.today().strftime('%Y.%m.%d')
         return today + ' ' + self.cfg.get('name')
 
 
-    def isDaytime(self):
-        '''algorithm for daytime estimation.
-           if the average pixel intensity is less than 10, we assume it is night.
-           this may be tweaked for special use cases.'''
-        oldres = self.cam.resolution
-        self.cam.resolution = (320, 240)
-        self.cam.iso = self.cfg.get('dayiso')
-        self.cam.shutter_speed = 1000000 // self.cfg.get('dayshutter')
-        output = np.empty((240, 320, 3), dtype=np.uint8)
-        self.cam.capture(output, 'rgb')
-        self.cam.resolution = oldres
-        debug("Daytime estimation mean value: " + str(output.mean()))
-        return output.mean() > 10
+    def isDaytime(self, newcycle=False):
+        '''day/night estimation, using the strategy selected in the config (see daynight.py).
+           by default, a low-resolution video port frame is measured once per cycle, and
+           it is assumed to be night if the average pixel intensity is less than 10.'''
+        return self.estimator.update(newcycle)
 
 
     def setWB(self):
@@ -78,23 +154,31 @@ class Experimenter(threading.Thread):
 
     def takePicture(self, name, plate_no):
         filename = ""
-        stream = BytesIO()
+        # one consistent set of settings for the whole capture
+        cfg = self.cfg.snapshot()
+        fmt = cfg.imageformat
+        ext = extension(fmt)
         prev_daytime = self.daytime
-        self.daytime = self.isDaytime()
+        with self.timer.stage('daynight'):
+            self.daytime = self.isDaytime(newcycle=plate_no == 0)
         
         if self.daytime:
-            time.sleep(0.5)
-            self.cam.shutter_speed = 1000000 // self.cfg.get('dayshutter')
-            self.cam.iso = self.cfg.get('dayiso')
+            # the day/night estimate may have changed the camera settings; wait for the view to
+            # be steady again, which is immediate if nothing has changed
+            with self.timer.stage('settle'):
+                self.settler.wait()
+            self.cam.shutter_speed = 1000000 // cfg.dayshutter
+            self.cam.iso = cfg.dayiso
             self.cam.color_effects = None
-            filename = os.path.join(self.dir, name + "-day.png")
+            filename = os.path.join(self.dir, name + "-day" + ext)
         else:
             # turn on led
             self.hw.LEDControl(True)
-            time.sleep(0.5)
-            self.cam.shutter_speed = 1000000 // self.cfg.get('nightshutter')
-            self.cam.iso = self.cfg.get('nightiso')
-            filename = os.path.join(self.dir, name + "-night.png")
+            with self.timer.stage('settle'):
+                self.settler.wait()
+            self.cam.shutter_speed = 1000000 // cfg.nightshutter
+            self.cam.iso = cfg.nightiso
+            filename = os.path.join(self.dir, name + "-night" + ext)
         
         if prev_daytime != self.daytime and self.daytime and self.cam.awb_mode != "off":
             # if there is a daytime shift, AND it is daytime, AND white balance was not previously set,
@@ -105,43 +189,121 @@ class Experimenter(threading.Thread):
         debug("Capturing %s." % filename)
         self.cam.exposure_mode = "off"
 
-        self.cam.capture(stream, format='rgb')
+        # capture straight into a preallocated frame buffer, which is then handed to the encoder.
+        # this blocks if all buffers are still waiting to be encoded.
+        with self.timer.stage('bufferwait'):
+            index = self.encoder.buffers.acquire()
+        try:
+            with self.timer.stage('capture'):
+                self.cam.capture(self.encoder.buffers.arrays[index].reshape(-1), format='rgb')
+        except Exception:
+            self.encoder.buffers.release(index)
+            raise
+        finally:
+            # turn off LED immediately after capture
+            if not self.daytime:
+                self.hw.LEDControl(False)
 
-        # turn off LED immediately after capture
-        if not self.daytime:
-            self.hw.LEDControl(False)
+        # hand the frame over to the image writer, which encodes it while the stage rotates
+        self.writer.submit(Frame(filename, plate_no, index, tuple(self.cam.resolution), self.daytime,
+                                 fmt=fmt, level=cfg.compresslevel, cycle=self.cycle,
+                                 shutter=self.cam.shutter_speed, iso=self.cam.iso))
 
-        # convert to PNG using PIL
-        # saving as 'RGB' using picamera adds a border which needs to be cropped away
-        # the raw capture size depends on the type of camera used
-        # we only support 5 MP (OV5647) and 8 MP (IMX219) cameras, for now at least
-        if self.cam.resolution[0] == 3280:
-            raw_res = (3296, 2464)
-        elif self.cam.resolution[0] == 2592:
-            raw_res = (2592, 1952)
-        else:
-            # unsupported resolution, try to make the best of it
-            debug('Camera has unsupported resolution ' + str(cam.resolution) + '! This may lead to crashes or corrupted images.')
-            raw_res = tuple(cam.resolution)
-        stream.seek(0)
-        im = Image.frombytes('RGB', raw_res, stream.read()).crop(box=(0,0)+self.cam.resolution)
-        im.save(filename)
-
-        # make thumbnail previews for experiment overview page
-        im.thumbnail((800, 600))
-        self.preview_lock.acquire()
-        self.preview[plate_no] = BytesIO()
-        im.save(self.preview[plate_no], format="jpeg")
-        self.preview_lock.release()
-        im.close()
-
-        self.last_captured[plate_no] = filename
         self.cam.color_effects = None
         self.cam.shutter_speed = 0
         # we leave the cam in auto exposure mode to improve daytime assessment performance
         self.cam.exposure_mode = "auto"
 
 
+    def saveImage(self, frame):
+        '''encodes a raw frame in the encoder pool, or appends it to the raw archive.
+           runs in the image writer threads.'''
+        try:
+            archive = None
+            if self.rawmode:
+                archive = rawarchive.get(rawarchive.archivePath(self.dir, frame.plate_no), frame.res, self.rawcapacity)
+                if archive.full():
+                    log("Raw frame archive is full, encoding image instead.")
+                    archive = None
+            if archive:
+                preview = self.archiveImage(archive, frame)
+                usage.add(frame.filename, frame.res[0] * frame.res[1] * 3, frame.captured)
+                self.manifest.add(frame.filename, frame.plate_no + 1, frame.captured, frame.daytime,
+                                  frame.shutter, frame.iso, archived=True)
+            else:
+                preview, size, times, crc = self.encoder.encode(frame.buffer, frame.res, frame.filename,
+                                                                frame.fmt, frame.level)
+                usage.add(frame.filename, size, frame.captured)
+                self.manifest.add(frame.filename, frame.plate_no + 1, frame.captured, frame.daytime,
+                                  frame.shutter, frame.iso, size, times['encode'] + times['write'], crc)
+                for stage, seconds in times.items():
+                    self.timer.add(stage, seconds, frame.cycle)
+                debug("Encoded %s (%d bytes) in %.2f s." % (frame.filename, size, sum(times.values())))
+        finally:
+            self.encoder.buffers.release(frame.buffer)
+
+        # thumbnail preview for experiment overview page
+        with self.preview_lock:
+            self.preview[frame.plate_no] = BytesIO(preview)
+            self.preview_seq[frame.plate_no] += 1
+            self.last_captured[frame.plate_no] = frame.filename
+        # the file browser thumbnail is made from the preview, which is much cheaper than from the image
+        thumbs.add(frame.filename, preview)
+
+
+    def archiveImage(self, archive, frame):
+        '''appends a frame to a raw archive for later conversion, and returns a JPEG preview of it'''
+        view = self.encoder.buffers.view(frame.buffer, frame.res)
+        stem = os.path.splitext(os.path.basename(frame.filename))[0]
+        start = time.perf_counter()
+        archive.append(view, frame.captured, frame.daytime, stem)
+        self.timer.add('write', time.perf_counter() - start, frame.cycle)
+        debug("Archived %s in %.2f s." % (stem, time.perf_counter() - start))
+
+        # subsampling is much cheaper than decoding and resizing the full frame
+        with self.timer.stage('preview', frame.cycle):
+            im = Image.fromarray(np.ascontiguousarray(view[::4, ::4]))
+            try:
+                im.thumbnail((800, 600))
+                preview = BytesIO()
+                im.save(preview, format="jpeg")
+            finally:
+                im.close()
+        return preview.getvalue()
+
+
+    def convertRaw(self):
+        '''converts one archived frame to an image file, if there is enough time left before the
+           next cycle. returns True if a frame was converted.'''
+        # encoding a full frame takes several seconds on a pi; leave a generous margin
+        if self.scheduler.stopped() or self.scheduler.remaining() < 30:
+            return False
+        for i in range(4):
+            path = rawarchive.archivePath(self.dir, i)
+            if not os.path.exists(path):
+                continue
+            archive = rawarchive.get(path)
+            pending = archive.pending()
+            if not pending:
+                continue
+            n, ts, flags, stem = pending[0]
+            fmt = self.cfg.get('imageformat')
+            filename = os.path.join(self.dir, "plate" + str(i + 1), stem + extension(fmt))
+            index = self.encoder.buffers.acquire()
+            try:
+                self.encoder.buffers.view(index, archive.res)[:] = archive.frame(n)
+                preview, size, times, crc = self.encoder.encode(index, archive.res, filename, fmt, self.cfg.get('compresslevel'))
+            finally:
+                self.encoder.buffers.release(index)
+            archive.markConverted(n)
+            usage.add(filename, size, ts, new=False)
+            self.manifest.convert(filename, size, times['encode'] + times['write'], crc)
+            self.timer.add('convert', times['encode'] + times['write'])
+            debug("Converted archived frame %s in %.2f s." % (filename, times['encode'] + times['write']))
+            return True
+        return False
+
+
     def run(self):
         '''starts experiment if there is signal to do so'''
         while not self.quit:
@@ -165,13 +327,21 @@ class Experimenter(threading.Thread):
 
         try:
             debug("Starting experiment.")
-            self.running = True
+            with self.encoder_lock:
+                # from here on, config changes leave the encoder alone until the experiment stops
+                self.running = True
+                self.setupEncoder()
             self.status = "Initiating"
+            # always find the start position at the start of an experiment
+            self.homed_cycles = self.cfg.get('homeinterval')
+            self.estimator = daynight.create(self.cam, self.cfg)
+            self.settler = SettleDetector(self.cam, self.cfg)
             self.starttime = time.time()
             self.endtime = time.time() + 60 * 60 * 24 * self.duration
             self.last_captured = [''] * 4
             self.delay = self.delay or 0.001
             self.nshots = self.duration * 24 * 60 // self.delay
+            self.rawcapacity = int(self.nshots) + 1
             self.cam.exposure_mode = "auto"
             self.cam.shutter_speed = 0
             self.hw.LEDControl(False)
@@ -183,53 +353,99 @@ class Experimenter(threading.Thread):
             for i in range(4):
                 platedir = "plate" + str(i + 1)
                 os.makedirs(os.path.join(self.dir, platedir), exist_ok=True)
+            # start the disk usage index, which is then kept up to date as images are written
+            usage.get(self.dir)
+            self.manifest = Manifest(self.dir)
+
+            # reset the peak memory usage, so that it is reported per cycle
+            peakRSS()
+
+            # cycles are started on a fixed schedule, as we do not know how long a rotation takes
+            self.scheduler = Scheduler(60 * self.delay, 60 * 60 * 24 * self.duration, self.cfg.get('overrunpolicy'))
+            if self.stop_experiment:
+                self.scheduler.stop()
+
+            while self.scheduler.waitNext() is not None:
+                self.cycle = self.timer.startCycle(late=self.scheduler.late)
+                setContext(cycle=self.cycle)
 
-            while time.time() < self.endtime and not self.stop_experiment:
-                loopstart = time.time()
-                # need to use time-based loop control as we do not know how long a rotation takes
-                nextloop = time.time() + 60 * self.delay
-                if nextloop > self.endtime:
-                    nextloop = self.endtime
-                
                 for i in range(4):
+                    setContext(cycle=self.cycle, plate=i + 1)
                     # rotate stage to starting position
                     if i == 0:
                         self.hw.motorOn(True)
-                        self.status = "Finding start position"
-                        debug("Finding initial position.")
-                        self.hw.findStart(calibration=self.cfg.get('calibration'))
-                        debug("Found initial position.")
+                        if self.hw.position is None or self.hw.rehome or self.homed_cycles >= self.cfg.get('homeinterval'):
+                            self.status = "Finding start position"
+                            debug("Finding initial position.")
+                            with self.timer.stage('findstart'):
+                                self.hw.findStart(calibration=self.cfg.get('calibration'))
+                            debug("Found initial position.")
+                            self.homed_cycles = 0
+                        else:
+                            # the position is tracked since the start position was last found
+                            debug("Returning to start position.")
+                            with self.timer.stage('rotate'):
+                                self.hw.moveTo(0)
+                        self.homed_cycles += 1
                         if self.status != "Stopping": self.status = "Imaging"
                     else:
                         # rotate cube 90 degrees
                         debug("Rotating stage.")
-                        self.hw.halfStep(100, 0.03)
+                        with self.timer.stage('rotate'):
+                            self.hw.moveTo(100 * i)
 
                     # wait for the cube to stabilize
-                    time.sleep(0.5)
+                    with self.timer.stage('settle'):
+                        self.settler.wait()
 
                     now = time.strftime("%Y%m%d-%H%M%S", time.localtime())
                     name = os.path.join("plate" + str(i + 1), "plate" + str(i + 1) + "-" + now)
                     self.takePicture(name, i)
 
-                self.nshots -= 1
+                setContext(cycle=self.cycle)
                 self.hw.motorOn(False)
+                elapsed, n = self.estimator.cycleStats()
+                debug("Day/night estimation took %.2f s this cycle (%d measurements)." % (elapsed, n))
+                rss = peakRSS()
+                if rss: debug("Peak RSS during cycle: %.1f MB" % rss)
                 if self.status != "Stopping": self.status = "Waiting"
 
                 if self.idlepos > 0:
                     # alternate between resting positions during idle, stepping 45 degrees per image
                     self.hw.motorOn(True)
-                    self.hw.halfStep(50 * self.idlepos, 0.03)
+                    with self.timer.stage('idlemove'):
+                        self.hw.halfStep(50 * self.idlepos)
                     self.hw.motorOn(False)
 
                 self.idlepos += 1
                 if self.idlepos > 7:
                     self.idlepos = 0
+                self.timer.endCycle()
+                self.scheduler.cycleDone()
+                self.nshots = self.scheduler.cyclesLeft()
 
-                while time.time() < nextloop and not self.stop_experiment:
-                    time.sleep(1)
+                # use idle time for converting archived raw frames
+                while self.rawmode and self.convertRaw():
+                    pass
 
         finally:
+            if self.writer.pending():
+                self.status = "Saving images"
+                debug("Waiting for %d queued images to be written." % self.writer.pending())
+            self.writer.drain()
+            usage.flush(self.dir)
+            if self.manifest:
+                self.manifest.close()
+                self.manifest = None
+            self.timer.endCycle()
+            setContext()
+            if self.rawmode:
+                for platedir, path in rawarchive.plateArchives(self.dir):
+                    remaining = len(rawarchive.get(path).pending())
+                    rawarchive.release(path)
+                    if remaining:
+                        log("%d raw frames in %s are not yet converted. Convert them using: spiro --convert-raw '%s'"
+                            % (remaining, path, self.dir))
             log("Experiment stopped.")
             self.cam.color_effects = None
             self.status = "Stopped"
@@ -7,11 +7,11 @@ import traceback
 import subprocess
 
 from waitress import serve
-from flask import Flask, render_template, Response
+from flask import Flask, render_template, request
 
 from spiro.config import Config
 from spiro.logger import log, debug
-from spiro.webui import stream_popen
+from spiro import logview
 
 app = Flask(__name__)
 app.jinja_env.trim_blocks = True
@@ -28,8 +28,7 @@ def index():
 
 @app.route('/log')
 def get_log():
-    p = subprocess.Popen(['/bin/journalctl', '--user-unit=spiro', '-n', '1000'], stdout=subprocess.PIPE)
-    return Response(stream_popen(p), mimetype='text/plain')
+    return logview.response(request)
 
 
 @app.route('/shutdown')
@@ -0,0 +1,122 @@
+# fakegpio.py -
+#   stand-in for the RPi.GPIO module, for testing and benchmarking the motor
+#   control code off-device. records the time of every step the motor takes.
+#
+
+import time
+
+
+class FakeGPIO(object):
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    # half step coil sequence, as used by HWControl
+    halfstep_seq = [(1,0,0,0), (1,0,1,0), (0,0,1,0), (0,1,1,0),
+                    (0,1,0,0), (0,1,0,1), (0,0,0,1), (1,0,0,1)]
+
+    def __init__(self, coils=(25, 24, 18, 15), sensor_pin=None, sensor=None):
+        '''coils are the coil pins of the stepper motor, in sequence order. sensor, if given,
+           is called with this object to give the value of sensor_pin, e.g. based on the
+           simulated motor position.'''
+        self.coils = list(coils)
+        self.position = 0
+        self.sensor_pin = sensor_pin
+        self.sensor = sensor
+        self.values = {}
+        self.modes = {}
+        self.steps = []
+        self.writes = []
+        self.callbacks = {}
+        self.sensor_state = 0
+        self.phase = None
+
+
+    def setmode(self, mode):
+        self.mode = mode
+
+
+    def setwarnings(self, value):
+        pass
+
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        for p in (pin if isinstance(pin, (list, tuple)) else [pin]):
+            self.modes[p] = mode
+            self.values[p] = initial or 0
+
+
+    def output(self, pin, value):
+        '''sets one or several pins, like RPi.GPIO.output'''
+        now = time.perf_counter()
+        pins = pin if isinstance(pin, (list, tuple)) else [pin]
+        values = value if isinstance(value, (list, tuple)) else [value] * len(pins)
+        stepped = False
+        for p, v in zip(pins, values):
+            v = int(bool(v))
+            self.writes.append((now, p, v))
+            # a half step changes the state of exactly one coil
+            if p in self.coils and self.values.get(p, 0) != v:
+                stepped = True
+            self.values[p] = v
+        if stepped:
+            state = tuple(self.values.get(c, 0) for c in self.coils)
+            if state in self.halfstep_seq:
+                # follow the motor position through the coil sequence
+                i = self.halfstep_seq.index(state)
+                if self.phase is not None:
+                    self.position += 1 if i == (self.phase + 1) % 8 else -1 if i == (self.phase - 1) % 8 else 0
+                self.phase = i
+                self.steps.append(now)
+                self.checkEdges()
+
+
+    def checkEdges(self):
+        '''fires the edge callbacks for the sensor pin, if its value has changed'''
+        if self.sensor_pin is None or not self.sensor:
+            return
+        state = self.input(self.sensor_pin)
+        edge, callback = self.callbacks.get(self.sensor_pin, (None, None))
+        if callback and state != self.sensor_state and \
+                (edge == self.BOTH or (edge == self.RISING) == bool(state)):
+            callback(self.sensor_pin)
+        self.sensor_state = state
+
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self.callbacks:
+            raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+        self.callbacks[pin] = (edge, callback)
+
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+
+    def input(self, pin):
+        if pin == self.sensor_pin and self.sensor:
+            return int(bool(self.sensor(self)))
+        return self.values.get(pin, 0)
+
+
+    def cleanup(self):
+        self.values = {}
+
+
+    def reset(self):
+        '''clears the recorded steps and writes'''
+        self.steps = []
+        self.writes = []
+
+
+    def intervals(self):
+        '''returns the times between consecutive recorded steps'''
+        return [b - a for a, b in zip(self.steps, self.steps[1:])]
@@ -0,0 +1,112 @@
+# httpcache.py -
+#   conditional requests and cache headers for the web ui, so that repeated views of
+#   images and static files cost little more than a 304 response
+#
+
+import os
+import gzip
+import mimetypes
+import threading
+from datetime import datetime, timezone
+from flask import Response, request, send_file, abort
+
+# one year, for static files requested with their version in the url
+immutable_age = 365 * 24 * 3600
+# file types worth compressing
+compressible = ('.css', '.js', '.svg', '.html', '.txt')
+
+
+def fileTag(path, st=None):
+    '''returns a strong etag for a file, from its modification time and size'''
+    st = st or os.stat(path)
+    return '%x-%x' % (st.st_mtime_ns, st.st_size)
+
+
+def notModified(etag, mtime=None, cache_control='no-cache'):
+    '''returns a 304 response if the client already has this version, otherwise None'''
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif mtime is not None and request.if_modified_since:
+        fresh = int(mtime) <= request.if_modified_since.timestamp()
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    response = Response(status=304)
+    return headers(response, etag, mtime, cache_control)
+
+
+def sendFile(path, mimetype=None, cache_control='no-cache', st=None):
+    '''responds with a file from disk, answering conditional and range requests. the open file
+       is handed to the server's file wrapper, which sends it in blocks, so the memory used per
+       download does not depend on the size of the file.'''
+    st = st or os.stat(path)
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=fileTag(path, st), last_modified=int(st.st_mtime))
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def headers(response, etag, mtime=None, cache_control='no-cache'):
+    '''sets the validators and the cache-control header of a response'''
+    response.set_etag(etag)
+    if mtime is not None:
+        response.last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+class StaticFiles(object):
+    '''serves the static files with etags and gzip compression. each compressible file is
+       compressed once, and kept in memory; the files are small. files requested with a
+       version (see version()) may be cached by the browser for a year.'''
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.compressed = {}
+        self.versions = {}
+
+
+    def version(self, filename):
+        '''returns a version string for a static file, for adding to its url'''
+        version = self.versions.get(filename)
+        if version is None:
+            try:
+                version = '%x' % os.stat(os.path.join(self.folder, filename)).st_mtime_ns
+            except OSError:
+                version = '0'
+            self.versions[filename] = version
+        return version
+
+
+    def gzipped(self, path, st):
+        '''returns the gzip-compressed contents of a file, compressing it on first use'''
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            data = self.compressed.get(key)
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = gzip.compress(f.read(), 9, mtime=0)
+                self.compressed[key] = data
+            return data
+
+
+    def serve(self, filename):
+        path = os.path.realpath(os.path.join(self.folder, filename))
+        if not path.startswith(os.path.realpath(self.folder) + os.sep) or not os.path.isfile(path):
+            abort(404)
+        st = os.stat(path)
+        if request.args.get('v') == self.version(filename):
+            cache_control = 'public, max-age=%d, immutable' % immutable_age
+        else:
+            cache_control = 'public, no-cache'
+        if filename.endswith(compressible) and 'gzip' in request.accept_encodings:
+            etag = fileTag(path, st) + '-gz'
+            response = notModified(etag, st.st_mtime, cache_control)
+            if response is None:
+                response = Response(self.gzipped(path, st), mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = 'gzip'
+                headers(response, etag, st.st_mtime, cache_control)
+        else:
+            response = sendFile(path, cache_control=cache_control, st=st)
+        response.vary.add('Accept-Encoding')
+        return response
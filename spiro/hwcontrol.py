@@ -2,15 +2,26 @@
 #   various functions for controlling the spiro hardware
 #
 
-import RPi.GPIO as gpio
+try:
+    import RPi.GPIO as gpio
+except ImportError:
+    # allows running the motor code off-device with a stand-in backend (see fakegpio.py)
+    gpio = None
 import time
 import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
 from spiro.config import Config
 from spiro.logger import log, debug
+from spiro.metrics import Histogram
+from spiro.motion import stepDelays
 
 class HWControl:
-    def __init__(self):
-        gpio.setmode(gpio.BCM)
+    def __init__(self, backend=None):
+        self.gpio = backend or gpio
+        self.gpio.setmode(self.gpio.BCM)
         self.cfg = Config()
         self.pins = {
             'LED' : self.cfg.get('LED'),
@@ -24,78 +35,278 @@ class HWControl:
             'stdby' : self.cfg.get('stdby')
         }
         self.led = False
+        self.motionSettingsChanged(self.cfg.snapshot())
+        self.cfg.subscribe(self.motionSettingsChanged, keys=['startspeed', 'maxspeed', 'acceleration', 'motionprofile'])
         self.GPIOInit()
+        # moves are made by a dedicated thread, so that step timing does not depend on the caller
+        self.jitter = Histogram()
+        self.homing_edge = threading.Event()
+        self.homing_history = deque(maxlen=50)
+        self.moves = queue.Queue()
+        self.motor_thread = threading.Thread(target=self.motorWorker, name='motor', daemon=True)
+        self.motor_thread.start()
 
 
     def GPIOInit(self):
-        gpio.setwarnings(False)
-        gpio.setup(self.pins['LED'], gpio.OUT)
-        gpio.setup(self.pins['sensor'], gpio.IN, pull_up_down=gpio.PUD_DOWN)
-        gpio.setup(self.pins['PWMa'], gpio.OUT)
-        gpio.setup(self.pins['PWMb'], gpio.OUT)
-        gpio.setup(self.pins['coilpin_M11'], gpio.OUT)
-        gpio.setup(self.pins['coilpin_M12'], gpio.OUT)
-        gpio.setup(self.pins['coilpin_M21'], gpio.OUT)
-        gpio.setup(self.pins['coilpin_M22'], gpio.OUT)
-        gpio.setup(self.pins['stdby'], gpio.OUT)
-        gpio.output(self.pins['PWMa'], True)
-        gpio.output(self.pins['PWMb'], True)
+        self.gpio.setwarnings(False)
+        self.gpio.setup(self.pins['LED'], self.gpio.OUT)
+        self.gpio.setup(self.pins['sensor'], self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+        self.gpio.setup(self.pins['PWMa'], self.gpio.OUT)
+        self.gpio.setup(self.pins['PWMb'], self.gpio.OUT)
+        self.gpio.setup(self.pins['coilpin_M11'], self.gpio.OUT)
+        self.gpio.setup(self.pins['coilpin_M12'], self.gpio.OUT)
+        self.gpio.setup(self.pins['coilpin_M21'], self.gpio.OUT)
+        self.gpio.setup(self.pins['coilpin_M22'], self.gpio.OUT)
+        self.gpio.setup(self.pins['stdby'], self.gpio.OUT)
+        self.gpio.output(self.pins['PWMa'], True)
+        self.gpio.output(self.pins['PWMb'], True)
+        # the coil pins and the coil states of the half step sequence, precomputed so that
+        # each step is a single multi-channel write
+        self.coilpins = [self.pins[p] for p in ('coilpin_M11', 'coilpin_M12', 'coilpin_M21', 'coilpin_M22')]
+        self.coil_states = [tuple(bool(v) for v in state) for state in self.halfstep_seq]
+        # the switch is watched during moves, to check the tracked position against it
+        try:
+            self.gpio.remove_event_detect(self.pins['sensor'])
+        except RuntimeError:
+            pass
+        self.gpio.add_event_detect(self.pins['sensor'], self.gpio.RISING, callback=self.sensorEdge, bouncetime=20)
         self.LEDControl(False)
         self.motorOn(False)
 
 
     def cleanup(self):
-        gpio.cleanup()
+        self.gpio.cleanup()
 
 
     def findStart(self, calibration=None):
-        """rotates the imaging stage until the positional switch is activated"""
+        """rotates the imaging stage until the positional switch is activated. the move is
+           stopped by the edge interrupt of the switch, and the steps taken after the edge are
+           subtracted from the calibration. in precise homing mode, the stage then backs off
+           the switch and approaches it again at a low speed."""
         calibration = calibration or self.cfg.get('calibration')
         timeout = 60
-        starttime = time.time()
+        starttime = time.monotonic()
+        sensor = lambda: self.gpio.input(self.pins['sensor'])
+        timed_out = lambda: time.monotonic() >= starttime + timeout
+        # approach the switch at a moderate speed, so that the stage stops promptly when it is hit
+        speed = min(self.cfg.get('homingspeed'), self.cfg.get('maxspeed'))
+        mode = self.cfg.get('homingmode')
+        known = self.position is not None
+        self.rehome = False
+        self.homing = True
+        try:
+            # make sure that switch is not depressed when starting
+            if sensor():
+                self.move(400, maxspeed=speed, stop=lambda: not sensor() or timed_out())
+            overshoot = self.approachSwitch(speed, timed_out)
+            if overshoot is not None and mode == 'precise':
+                self.move(-400, maxspeed=speed, stop=lambda: not sensor() or timed_out())
+                self.move(-self.homing_backoff, maxspeed=speed)
+                overshoot = self.approachSwitch(self.cfg.get('homingslowspeed'), timed_out)
+        finally:
+            self.homing = False
 
-        # make sure that switch is not depressed when starting
-        if gpio.input(self.pins['sensor']):
-            while gpio.input(self.pins['sensor']) and time.time() < starttime + timeout:
-                self.halfStep(1, 0.03)
-
-        while not gpio.input(self.pins['sensor']) and time.time() < starttime + timeout:
-            self.halfStep(1, 0.03)
-
-        if time.time() < starttime + timeout:
-            self.halfStep(calibration, 0.03)
+        if overshoot is not None:
+            # the offset of the switch from where it was expected tells how repeatable homing is
+            offset = (self.edge_position - self.switchPosition() + 200) % 400 - 200 if known else None
+            self.halfStep(calibration - overshoot)
+            self.position = 0
+            self.calibration = calibration
+            self.homing_history.append((time.monotonic() - starttime, overshoot, offset, mode))
+            debug("Found start position in %.2f s, %d steps overshoot." % (time.monotonic() - starttime, overshoot))
         else:
+            self.position = None
             log("Timed out while finding start position! Images will be misaligned.")
 
 
+    def approachSwitch(self, speed, timed_out):
+        """turns the stage forward until the edge interrupt of the switch arrives. returns the
+           number of steps taken after the edge, or None if timed out."""
+        self.homing_edge.clear()
+        while not self.homing_edge.is_set() and not timed_out():
+            self.move(400, maxspeed=speed, stop=lambda: self.homing_edge.is_set() or timed_out())
+        if not self.homing_edge.is_set():
+            return None
+        return self.stepcount - self.edge_step
+
+
+    def homingStats(self):
+        """returns a dict with statistics on the recent homing runs, or None if there are none.
+           repeatability is the standard deviation, in half steps, of the switch position from
+           where the tracked position expected it."""
+        if not self.homing_history:
+            return None
+        times = [t for t, overshoot, offset, mode in self.homing_history]
+        overshoots = [overshoot for t, overshoot, offset, mode in self.homing_history]
+        offsets = [offset for t, overshoot, offset, mode in self.homing_history if offset is not None]
+        stats = {'count': len(times), 'mean_time': sum(times) / len(times), 'max_time': max(times),
+                 'mean_overshoot': sum(overshoots) / len(overshoots), 'max_overshoot': max(overshoots),
+                 'repeatability': None, 'max_offset': None, 'last': self.homing_history[-1]}
+        if offsets:
+            mean = sum(offsets) / len(offsets)
+            stats['repeatability'] = (sum((o - mean) ** 2 for o in offsets) / len(offsets)) ** 0.5
+            stats['max_offset'] = max(abs(o) for o in offsets)
+        return stats
+
+
     # sets the motor pins as element in sequence
     def setStepper(self, M_seq, i):
-        gpio.output(self.pins['coilpin_M11'], M_seq[i][0])
-        gpio.output(self.pins['coilpin_M12'], M_seq[i][1])
-        gpio.output(self.pins['coilpin_M21'], M_seq[i][2])
-        gpio.output(self.pins['coilpin_M22'], M_seq[i][3])
+        self.gpio.output(self.coilpins, M_seq[i])
 
 
     # steps the stepper motor using half steps, "delay" is time between coil change
+    # without a delay, the move follows the configured motion profile
     # 400 steps is 360 degrees
-    def halfStep(self, steps, delay, keep_motor_on=False):
+    def halfStep(self, steps, delay=None, keep_motor_on=False):
+        if delay:
+            return self.move(steps, delays=(delay,) * steps)
+        return self.move(steps)
+
+
+    def motionSettingsChanged(self, cfg, changed=None):
+        self.motion = (cfg.startspeed, cfg.maxspeed, cfg.acceleration, cfg.motionprofile)
+
+
+    def profile(self, steps, maxspeed=None):
+        """returns the delays after each step for a move, according to the configured profile"""
+        startspeed, default_maxspeed, accel, profile = self.motion
+        return stepDelays(steps, startspeed, maxspeed or default_maxspeed, accel, profile)
+
+
+    def moveTo(self, target):
+        """moves the stage to a position, given in half steps from the start position, along
+           the shortest path. finds the start position first if the position is not known."""
+        if self.position is None:
+            self.findStart()
+        delta = (target - self.position) % 400
+        if delta > 200:
+            delta -= 400
+        return self.move(delta)
+
+
+    def move(self, steps, maxspeed=None, delays=None, stop=None):
+        """makes a move of a number of half steps, backwards if steps is negative. the move
+           ends early if the stop function returns true before a step. returns the number of
+           steps taken."""
+        return self.submitMove(steps, maxspeed, delays, stop).result()
+
+
+    def submitMove(self, steps, maxspeed=None, delays=None, stop=None):
+        """queues a move for the motor thread, see move(). returns a future for the number
+           of steps taken. moves are made one at a time, in the order they are submitted."""
+        future = Future()
+        self.moves.put((future, steps, maxspeed, delays, stop))
+        return future
+
+
+    def motorWorker(self):
+        """makes the queued moves. runs with real-time priority, if permitted."""
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.motor_priority))
+        except (AttributeError, OSError):
+            debug("Could not set real-time priority for the motor thread, using normal priority.")
+        while True:
+            future, steps, maxspeed, delays, stop = self.moves.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.runMove(steps, maxspeed, delays, stop))
+            except Exception as e:
+                future.set_exception(e)
+
+
+    def waitUntil(self, deadline):
+        """sleeps until shortly before the deadline, and spins for the rest of the time,
+           as sleeping is not precise enough for step timing"""
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            pass
+
+
+    def runMove(self, steps, maxspeed=None, delays=None, stop=None):
+        self.direction = 1 if steps >= 0 else -1
+        steps = abs(steps)
+        delays = delays or self.profile(steps, maxspeed)
+        startpos = self.position
+        self.edge_seen = False
         time.sleep(0.005) # time for motor to activate
+        # steps are timed against deadlines, so that time spent on the step itself does not add up.
+        # a late step moves the deadline rather than being caught up, as a burst of quick steps
+        # could make the motor lose steps.
+        output, coilpins, states = self.gpio.output, self.coilpins, self.coil_states
+        deadline = time.perf_counter()
         for i in range(0, steps):
-            self.setStepper(self.halfstep_seq, self.seqNumb)
+            if stop and stop():
+                steps = i
+                break
+            self.waitUntil(deadline)
+            now = time.perf_counter()
+            self.jitter.add(now - deadline)
+            if self.direction < 0:
+                # seqNumb is the next state in the forward direction
+                self.seqNumb = (self.seqNumb - 2) % 8
+            # the step is counted before it is made, so that an edge interrupt caused by it sees it
+            self.stepcount += 1
+            if self.position is not None:
+                self.position = (self.position + self.direction) % 400
+            output(coilpins, states[self.seqNumb])
             self.seqNumb += 1
             if(self.seqNumb == 8):
                 self.seqNumb = 0
-            time.sleep(delay)
+            deadline = max(deadline, now) + delays[i]
+        # wait out the delay after the last step, so that the stage has stopped when the move returns
+        if steps:
+            self.waitUntil(deadline)
+
+        if startpos is not None and self.position is not None and self.direction > 0 and not self.edge_seen \
+                and not self.homing:
+            # the switch should have been hit if the move passed over it
+            tolerance = self.cfg.get('positiontolerance')
+            d = (self.switchPosition() + tolerance - startpos) % 400
+            if d < steps and d >= 2 * tolerance:
+                log("Positional switch was not triggered where expected, will find start position again.")
+                self.position = None
+        self.direction = 0
+        return steps
+
+
+    def switchPosition(self):
+        """returns the tracked position where the positional switch is activated"""
+        return -self.calibration % 400
+
+
+    def sensorEdge(self, channel):
+        """called when the positional switch is activated. stops the move while finding the start
+           position, and otherwise checks that it agrees with the tracked position."""
+        if self.direction <= 0:
+            return
+        if self.homing:
+            self.edge_step = self.stepcount
+            self.edge_position = self.position
+            self.homing_edge.set()
+            return
+        if self.position is None:
+            return
+        offset = (self.position - self.switchPosition() + 200) % 400 - 200
+        self.edge_seen = True
+        if abs(offset) > self.cfg.get('positiontolerance'):
+            # the switch position is known well enough to carry on, but the start position
+            # should be found again at the next opportunity
+            log("Positional switch triggered %d steps from the tracked position, will find start position again." % offset)
+            self.position = self.switchPosition()
+            self.rehome = True
 
 
     # sets motor standby status
     def motorOn(self, value):
-        gpio.output(self.pins['stdby'], value)
+        self.gpio.output(self.pins['stdby'], value)
 
 
     # turns on and off led
     def LEDControl(self, value):
-        gpio.output(self.pins['LED'], value)
+        self.gpio.output(self.pins['LED'], value)
         self.led = value
 
 
@@ -113,9 +324,29 @@ class HWControl:
 
     # my copy of the pinout
     pins = {}
+
+    # real-time priority of the motor thread, and the time spun before each step instead of sleeping
+    motor_priority = 10
+    spin_time = 0.0005
     
     # state of stepper motor sequence
     seqNumb = 0
+
+    # tracked position of the stage in half steps from the start position (0-399),
+    # or None if it is not known
+    position = None
+    calibration = 0
+    rehome = False
+    direction = 0
+    edge_seen = False
+
+    # steps made since start, and the step and position at the last edge while finding the start position
+    stepcount = 0
+    homing = False
+    edge_step = 0
+    edge_position = None
+    # half steps to back off the switch before the slow approach in precise homing mode
+    homing_backoff = 10
     
     # sequence for one coil rotation of stepper motor using half step
     halfstep_seq = [(1,0,0,0), (1,0,1,0), (0,0,1,0), (0,1,1,0),
@@ -0,0 +1,88 @@
+# imagewriter.py -
+#   background encode/write stage for captured frames, so that the stage
+#   can rotate to the next plate while the previous image is being saved
+#
+
+import time
+import queue
+import threading
+from collections import deque
+from spiro.logger import log, debug, setContext
+
+
+class Frame(object):
+    '''a captured raw frame waiting to be encoded and written to disk'''
+    def __init__(self, filename, plate_no, buffer, res, daytime, fmt='png', level=6, cycle=None, shutter=None, iso=None):
+        self.filename = filename
+        self.plate_no = plate_no
+        self.buffer = buffer
+        self.res = res
+        self.daytime = daytime
+        self.fmt = fmt
+        self.level = level
+        self.cycle = cycle
+        self.shutter = shutter
+        self.iso = iso
+        self.captured = time.time()
+        self.error = None
+
+
+class ImageWriter(object):
+    '''bounded queue of frames, processed by a small pool of worker threads.
+       submit() blocks when the queue is full, which throttles the capture loop
+       instead of letting raw frames pile up in memory.'''
+    def __init__(self, process, workers=1, maxsize=2):
+        self.process = process
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.errors = deque(maxlen=20)
+        self.nwritten = 0
+        self.nfailed = 0
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.worker, name='imagewriter-' + str(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+
+    def submit(self, frame):
+        '''queues a frame for writing, waiting for a free slot if necessary'''
+        if self.queue.full():
+            debug("Image writer queue full, waiting for encoder.")
+        self.queue.put(frame)
+
+
+    def drain(self):
+        '''blocks until all queued frames have been written'''
+        self.queue.join()
+
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+
+    def close(self):
+        '''drains the queue and stops the worker threads'''
+        self.drain()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+    def worker(self):
+        while True:
+            frame = self.queue.get()
+            try:
+                if frame is None:
+                    return
+                setContext(cycle=frame.cycle, plate=frame.plate_no + 1)
+                self.process(frame)
+                self.nwritten += 1
+            except Exception as e:
+                frame.error = str(e)
+                self.nfailed += 1
+                self.errors.append((frame.filename, frame.error))
+                log("Failed to write image " + frame.filename + ": " + frame.error)
+            finally:
+                self.queue.task_done()
@@ -1,17 +1,137 @@
 # logger.py -
-#   simple functions for logging
+#   simple functions for logging. records are structured, kept in an in-memory
+#   ring buffer, and written to stderr from a background thread, so that logging
+#   never blocks the capture and motor code on i/o.
 #
 
 import sys
+import time
+import queue
+import atexit
+import itertools
+import threading
+from collections import deque, namedtuple
 from spiro.config import Config
 
+DEBUG = 10
+INFO = 20
+levels = {DEBUG: 'debug', INFO: 'info'}
+
+# seq is a running number, so that readers of the ring buffer can tell which records are new
+Record = namedtuple('Record', ['seq', 'time', 'level', 'component', 'cycle', 'plate', 'message'])
+
 cfg = Config()
+records = deque(maxlen=5000)
+pending = queue.Queue(maxsize=10000)
+dropped = 0
+sequence = itertools.count(1)
+context = threading.local()
+threshold = INFO
+# records from before this time are only in the system journal
+started = time.time()
+# notified by the writer thread when new records have been written
+written = threading.Condition()
+
+
+def debugChanged(snapshot, changed=None):
+    global threshold
+    threshold = DEBUG if snapshot.debug else INFO
+
+
+def setContext(cycle=None, plate=None):
+    '''sets the cycle and plate that records logged from the calling thread refer to'''
+    context.cycle = cycle
+    context.plate = plate
+
+
+def emit(level, msg, component, cycle, plate):
+    global dropped
+    if component is None:
+        component = sys._getframe(2).f_globals.get('__name__', '').rpartition('.')[2]
+    record = Record(next(sequence), time.time(), level, component,
+                    cycle if cycle is not None else getattr(context, 'cycle', None),
+                    plate if plate is not None else getattr(context, 'plate', None), msg)
+    records.append(record)
+    try:
+        pending.put_nowait(record)
+    except queue.Full:
+        # stderr is not keeping up; the record is still in the ring buffer
+        dropped += 1
+
+
+def log(msg, component=None, cycle=None, plate=None):
+    emit(INFO, msg, component, cycle, plate)
+
+
+def debug(msg, component=None, cycle=None, plate=None):
+    if threshold <= DEBUG:
+        emit(DEBUG, msg, component, cycle, plate)
+
+
+def matches(r, level=None, component=None, start=None, end=None):
+    '''returns true if a record is of at least the given level, from the given component,
+       and in the given time range'''
+    return (level is None or r.level >= level) and (component is None or r.component == component) \
+        and (start is None or r.time >= start) and (end is None or r.time < end)
+
+
+def recent(since=0, **filters):
+    '''returns the records in the ring buffer after sequence number since, optionally
+       filtered (see matches())'''
+    return [r for r in list(records) if r.seq > since and matches(r, **filters)]
+
+
+def latest():
+    '''returns the sequence number of the newest record'''
+    try:
+        return records[-1].seq
+    except IndexError:
+        return 0
+
+
+def wait(since, timeout=None):
+    '''waits until there are records newer than sequence number since. returns true if there are.'''
+    with written:
+        return written.wait_for(lambda: latest() > since, timeout)
+
+
+def writer():
+    global dropped
+    while True:
+        record = pending.get()
+        if record is None:
+            pending.task_done()
+            return
+        try:
+            if dropped:
+                n, dropped = dropped, 0
+                sys.stderr.write("(%d log records not written, output too slow)\n" % n)
+            sys.stderr.write(record.message + '\n')
+            if pending.empty():
+                sys.stderr.flush()
+        except (OSError, ValueError):
+            pass
+        pending.task_done()
+        if pending.empty():
+            with written:
+                written.notify_all()
+
+
+def flush():
+    '''waits until all records have been written'''
+    pending.join()
+
+
+def shutdown():
+    try:
+        pending.put(None, timeout=1)
+    except queue.Full:
+        return
+    thread.join(timeout=2)
 
-def log(msg):
-    sys.stderr.write(msg + '\n')
-    sys.stderr.flush()
 
-def debug(msg):
-    if cfg.get('debug'):
-        sys.stderr.write(msg + '\n')
-        sys.stderr.flush()
+debugChanged(cfg.snapshot())
+cfg.subscribe(debugChanged, keys=['debug'])
+thread = threading.Thread(target=writer, name='logger', daemon=True)
+thread.start()
+atexit.register(shutdown)
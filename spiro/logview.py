@@ -0,0 +1,139 @@
+# logview.py -
+#   serves the log from the in-process ring buffer, for the web ui and the failsafe ui.
+#   the system journal is only read on request, for entries from before the process started.
+#
+
+import time
+import threading
+import subprocess
+from datetime import datetime
+from flask import Response, abort
+from spiro import logger
+
+# followers each keep a waitress thread busy, so their number is limited
+max_followers = 2
+followers = 0
+followers_lock = threading.Lock()
+
+
+def parseTime(value):
+    '''parses a unix timestamp or an iso 8601 date and time, in local time'''
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        abort(400)
+
+
+def filters(args):
+    '''returns the record filters given in the query string: level (debug or info), component,
+       and start and end times'''
+    level = {name: level for level, name in logger.levels.items()}.get(args.get('level'))
+    return {'level': level, 'component': args.get('component') or None,
+            'start': parseTime(args.get('start')), 'end': parseTime(args.get('end'))}
+
+
+def formatRecord(r):
+    where = ''
+    if r.cycle is not None:
+        where = ' [cycle %d%s]' % (r.cycle, ', plate %d' % r.plate if r.plate is not None else '')
+    return '%s %-5s %s%s: %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r.time)),
+                                   logger.levels.get(r.level, r.level), r.component, where, r.message)
+
+
+def journal(start=None, lines=1000):
+    '''yields the journal entries of the spiro service from before this process started'''
+    cmd = ['/bin/journalctl', '--user-unit=spiro', '-n', str(lines), '--until=@%d' % logger.started]
+    if start:
+        cmd.append('--since=@%d' % start)
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except OSError:
+        return
+    with p:
+        data = p.stdout.read(128*1024)
+        while data:
+            yield data
+            data = p.stdout.read(128*1024)
+
+
+def text(args):
+    '''yields the filtered log as plain text. with journal=1 in the query, the entries from
+       before the process started are read from the system journal first.'''
+    f = filters(args)
+    try:
+        lines = max(1, min(int(args.get('n', 1000)), logger.records.maxlen))
+    except ValueError:
+        abort(400)
+    records = logger.recent(**f)[-lines:]
+    def generate():
+        if args.get('journal') and (f['start'] is None or f['start'] < logger.started):
+            yield from journal(f['start'], lines)
+        else:
+            yield ('-- Log since %s; add ?journal=1 for earlier entries --\n'
+                   % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logger.started))).encode()
+        oldest = logger.records[0] if logger.records else None
+        if oldest and oldest.seq > 1 and (f['start'] is None or f['start'] < oldest.time):
+            yield b'-- Older entries have been dropped from the log buffer --\n'
+        yield ''.join(formatRecord(r) for r in records).encode()
+    return generate()
+
+
+def event(r):
+    '''formats a record as a server-sent event, with a data line for each line of the message'''
+    return 'id: %d\n%s\n' % (r.seq, ''.join('data: %s\n' % line for line in formatRecord(r).splitlines()))
+
+
+def events(f, last_id=None, release=None, keepalive=10):
+    '''yields new records matching the filters f as server-sent events, as they are logged.
+       starts after the record with sequence number last_id, or with the last 100 records.
+       release is called when the stream ends.'''
+    since = int(last_id) if last_id and last_id.isdigit() else max(0, logger.latest() - 100)
+    try:
+        # tell the client to wait a while before reconnecting
+        yield b'retry: 5000\n\n'
+        while True:
+            if not logger.wait(since, keepalive):
+                # keeps the connection from timing out
+                yield b': keepalive\n\n'
+                continue
+            new = logger.recent(since=since)
+            if not new:
+                continue
+            since = new[-1].seq
+            chunk = ''.join(event(r) for r in new if logger.matches(r, **f))
+            if chunk:
+                yield chunk.encode()
+    finally:
+        if release:
+            release()
+
+
+def response(request):
+    '''returns the response for a log request, as plain text or as an event stream'''
+    global followers
+    if request.args.get('follow'):
+        f = filters(request.args)
+        # counted before the stream starts, so that concurrent requests cannot exceed the limit
+        with followers_lock:
+            if followers >= max_followers:
+                abort(503)
+            followers += 1
+        released = []
+        def release():
+            '''uncounts the follower, once, whether the stream ends or is closed before it starts'''
+            global followers
+            with followers_lock:
+                if not released:
+                    released.append(True)
+                    followers -= 1
+        response = Response(events(f, request.headers.get('Last-Event-ID'), release), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(release)
+        return response
+    return Response(text(request.args), mimetype='text/plain')
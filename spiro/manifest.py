@@ -0,0 +1,290 @@
+# manifest.py -
+#   per-experiment sqlite database with a record of every captured image, written as the
+#   images are saved, so that browsing and exporting an experiment need not scan and parse
+#   its directories. records are written in batches by a background thread.
+#
+
+import os
+import re
+import json
+import time
+import queue
+import base64
+import sqlite3
+import threading
+from datetime import datetime
+from spiro.logger import log, debug
+
+filename = 'manifest.sqlite'
+# the longest time a record waits before it is written, in seconds
+batch_delay = 1.0
+batch_size = 100
+# the time after which records that could not be written are tried again, in seconds
+retry_delay = 10
+
+# the state of the plate directories of each experiment when build() last went through them
+built = {}
+build_lock = threading.Lock()
+
+schema = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,          -- relative to the experiment directory, e.g. plate1/plate1-20240101-120000-day.png
+    plate INTEGER NOT NULL,         -- 1 to 4
+    captured REAL NOT NULL,         -- unix time
+    daytime INTEGER NOT NULL,
+    shutter INTEGER,                -- exposure time in microseconds
+    iso INTEGER,
+    size INTEGER,                   -- file size in bytes, or null while in a raw archive
+    encode_time REAL,               -- seconds spent encoding and writing the image
+    crc32 INTEGER,                  -- of the image file, as used in zip files
+    archived INTEGER NOT NULL DEFAULT 0     -- 1 while the frame waits in a raw archive
+);
+CREATE INDEX IF NOT EXISTS images_captured ON images (captured, path);
+CREATE INDEX IF NOT EXISTS images_plate ON images (plate, captured, path);
+'''
+
+insert = '''INSERT OR REPLACE INTO images (path, plate, captured, daytime, shutter, iso, size, encode_time, crc32, archived)
+             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+# the record of an archived frame is found by its file name stem, as the image format may have
+# changed between capture and conversion. paths from "stem." up to "stem/" are those of the stem.
+converted = '''UPDATE OR REPLACE images SET path = ?, size = ?, encode_time = ?, crc32 = ?, archived = 0
+               WHERE path > ? AND path < ?'''
+# for records made by build(), which leaves those written meanwhile by the experimenter alone
+missing = insert.replace('OR REPLACE', 'OR IGNORE')
+moved_sql = 'UPDATE OR REPLACE images SET path = ?, size = ?, archived = 0 WHERE path = ?'
+
+
+# capture time and day/night in the image file names, e.g. plate1-20240101-120000-day.png
+name_pattern = re.compile(r'-(\d{8}-\d{6})-(day|night)\.')
+# the largest number of images returned at once by page()
+max_page = 500
+
+
+def connect(expdir, readonly=True):
+    '''opens the manifest of an experiment. returns None if a read-only manifest does not exist.'''
+    path = os.path.join(expdir, filename)
+    if readonly:
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        # readers do not block the writer in wal mode, and with synchronous=normal the database
+        # stays consistent on power loss, at worst losing the last batch
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(schema)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def build(expdir):
+    '''makes or completes the manifest of an experiment from its image files and raw archives,
+       adding records for the images that have none: all of them for experiments from before
+       manifests were written, and otherwise those whose records could not be written. capture
+       times are then taken from the file names. the plate directories are only listed again
+       once they have changed.'''
+    # imported here, as the raw archives use this module
+    import spiro.rawarchive as rawarchive
+    import spiro.usage as usage
+    expdir = os.path.abspath(expdir)
+    with build_lock:
+        stamp = usage.stamp(expdir)[1:]
+        if built.get(expdir) == stamp:
+            return
+        start = time.perf_counter()
+        exists = os.path.exists(os.path.join(expdir, filename))
+        known = {}
+        if exists:
+            conn = connect(expdir)
+            try:
+                known = {r[0]: r[1] for r in conn.execute('SELECT path, archived FROM images')}
+            finally:
+                conn.close()
+        # the recorded path of each file name stem, for finding the records of archived frames
+        stems = {os.path.splitext(path)[0]: path for path in known}
+        rows = []
+        moved = []
+        for i in range(4):
+            plate = 'plate' + str(i + 1)
+            ext = '.png'
+            for entry in os.scandir(os.path.join(expdir, plate)):
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                path = plate + '/' + entry.name
+                stem, ext = os.path.splitext(path)
+                if known.get(path) == 0:
+                    continue
+                st = entry.stat()
+                if known.get(stems.get(stem)):
+                    # a converted frame whose record still has it in its archive
+                    moved.append((path, st.st_size, stems[stem]))
+                else:
+                    m = name_pattern.search(entry.name)
+                    captured = datetime.strptime(m.group(1), '%Y%m%d-%H%M%S').timestamp() if m else st.st_mtime
+                    rows.append((path, i + 1, captured, int(not m or m.group(2) == 'day'),
+                                 None, None, st.st_size, None, None, 0))
+                stems[stem] = path
+            try:
+                with rawarchive.reader(rawarchive.archivePath(expdir, i)) as archive:
+                    pending = archive.pending()
+            except FileNotFoundError:
+                pending = []
+            for n, ts, flags, stem in pending:
+                if plate + '/' + stem not in stems:
+                    rows.append((plate + '/' + stem + ext, i + 1, ts, int(bool(flags & rawarchive.DAY)),
+                                 None, None, None, None, None, 1))
+
+        if exists:
+            conn = connect(expdir, readonly=False)
+            try:
+                with conn:
+                    conn.executemany(moved_sql, moved)
+                    conn.executemany(missing, rows)
+            finally:
+                conn.close()
+        else:
+            # built under another name, so that an interrupted build is not taken for a manifest
+            tmp = os.path.join(expdir, '.' + filename + '.tmp')
+            conn = sqlite3.connect(tmp)
+            try:
+                conn.executescript(schema)
+                with conn:
+                    conn.executemany(insert, rows)
+            finally:
+                conn.close()
+            os.replace(tmp, os.path.join(expdir, filename))
+        built[expdir] = stamp
+        if rows or moved or not exists:
+            debug("%s %d records in the manifest of %s in %.2f s." % ('Added' if exists else 'Built a manifest with',
+                  len(rows) + len(moved), expdir, time.perf_counter() - start))
+
+
+def encodeCursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row['captured'], row['path']]).encode()).decode()
+
+
+def decodeCursor(cursor):
+    '''returns the capture time and path of the last image of the previous page'''
+    captured, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(captured), str(path)
+
+
+def conditions(plate=None, daytime=None, start=None, end=None):
+    '''returns the where clauses and parameters that select images by plate, day (true) or
+       night (false), and capture time range'''
+    where = []
+    params = []
+    if plate is not None:
+        where.append('plate = ?')
+        params.append(plate)
+    if daytime is not None:
+        where.append('daytime = ?')
+        params.append(int(daytime))
+    if start is not None:
+        where.append('captured >= ?')
+        params.append(start)
+    if end is not None:
+        where.append('captured < ?')
+        params.append(end)
+    return where, params
+
+
+def select(conn, plate=None, daytime=None, start=None, end=None):
+    '''returns a cursor over the selected images (see conditions()), in order of their paths'''
+    where, params = conditions(plate, daytime, start, end)
+    return conn.execute('SELECT * FROM images%s ORDER BY path' % (' WHERE ' + ' AND '.join(where) if where else ''), params)
+
+
+def page(conn, plate=None, daytime=None, start=None, end=None, descending=False, cursor=None, limit=100):
+    '''returns a list of images, and a cursor for the next page or None if this is the last one.
+       images are sorted by capture time, and selected as by conditions(). the cursor names the
+       last image returned, so pages stay consistent while images are added, and each page is
+       a single index range scan.'''
+    where, params = conditions(plate, daytime, start, end)
+    if cursor:
+        where.append('(captured, path) %s (?, ?)' % ('<' if descending else '>'))
+        params += decodeCursor(cursor)
+    limit = max(1, min(int(limit), max_page))
+    order = 'DESC' if descending else 'ASC'
+    sql = 'SELECT * FROM images%s ORDER BY captured %s, path %s LIMIT ?' % \
+          (' WHERE ' + ' AND '.join(where) if where else '', order, order)
+    # one more than asked for, to know whether there is a next page
+    rows = conn.execute(sql, params + [limit + 1]).fetchall()
+    images = [dict(r) for r in rows[:limit]]
+    return images, encodeCursor(rows[limit - 1]) if len(rows) > limit else None
+
+
+class Manifest(object):
+    '''writes records to the manifest of an experiment. add() and convert() only queue the
+       record, and never wait for the database.'''
+    def __init__(self, expdir):
+        self.expdir = os.path.abspath(expdir)
+        self.queue = queue.Queue()
+        self.conn = connect(self.expdir, readonly=False)
+        self.thread = threading.Thread(target=self.writer, name='manifest', daemon=True)
+        self.thread.start()
+
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), self.expdir)
+
+
+    def add(self, path, plate, captured, daytime, shutter=None, iso=None, size=None, encode_time=None,
+            crc32=None, archived=False):
+        '''records a captured image. plate is numbered from 1.'''
+        self.queue.put((insert, (self.relpath(path), plate, captured, int(daytime), shutter, iso,
+                                 size, encode_time, crc32, int(archived))))
+
+
+    def convert(self, path, size, encode_time=None, crc32=None):
+        '''records that an archived frame has been written to its image file, which may have
+           another extension than the one recorded at capture time'''
+        stem = os.path.splitext(self.relpath(path))[0]
+        self.queue.put((converted, (self.relpath(path), size, encode_time, crc32, stem + '.', stem + '/')))
+
+
+    def writer(self):
+        # records that could not be written are kept, in order, and written with the next batch
+        unwritten = []
+        while True:
+            try:
+                batch = [self.queue.get(timeout=retry_delay if unwritten else None)]
+            except queue.Empty:
+                batch = []
+            # wait a little for more records, so that a cycle's images are written in one transaction
+            try:
+                while batch and len(batch) < batch_size and batch[-1] is not None:
+                    batch.append(self.queue.get(timeout=batch_delay))
+            except queue.Empty:
+                pass
+            records = unwritten + [r for r in batch if r is not None]
+            if records:
+                try:
+                    with self.conn:
+                        for sql, params in records:
+                            self.conn.execute(sql, params)
+                    if unwritten:
+                        log("Wrote %d delayed records to the manifest of %s." % (len(records), self.expdir))
+                    unwritten = []
+                except sqlite3.Error as e:
+                    if not unwritten:
+                        log("Could not write %d records to the manifest of %s, will try again: %s" % (len(records), self.expdir, e))
+                    unwritten = records
+            if batch and batch[-1] is None:
+                if unwritten:
+                    log("%d records could not be written to the manifest of %s. They are added from the image "
+                        "files when the experiment is next browsed or downloaded." % (len(unwritten), self.expdir))
+                return
+
+
+    def close(self):
+        '''writes the queued records, and closes the database'''
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            # fold the write-ahead log back into the database file, so that it is self-contained
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            debug("Could not checkpoint the manifest of %s: %s" % (self.expdir, e))
+        self.conn.close()
@@ -0,0 +1,153 @@
+# metrics.py -
+#   timing of the stages of each experiment cycle
+#
+
+import time
+import bisect
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class CycleTimer(object):
+    '''collects the time spent in each stage of the experiment cycles. the most recent
+       cycles are kept in a ring buffer, and running totals are kept for all cycles.
+       stages that run in the background (e.g., encoding) may be added to a cycle after
+       it has ended, by giving its cycle number.'''
+    def __init__(self, maxlen=100):
+        self.lock = threading.Lock()
+        self.history = deque(maxlen=maxlen)
+        self.current = None
+        self.ncycles = 0
+        self.totals = {}
+
+
+    def startCycle(self, late=None):
+        '''starts timing a new cycle, and returns its cycle number. late is the number
+           of seconds the cycle started after its planned start time.'''
+        with self.lock:
+            self.ncycles += 1
+            self.current = {'cycle': self.ncycles, 'start': time.time(), 'duration': None,
+                            'late': late, 'stages': {}, 't0': time.monotonic()}
+            self.history.append(self.current)
+            return self.ncycles
+
+
+    def endCycle(self):
+        with self.lock:
+            if self.current:
+                self.current['duration'] = time.monotonic() - self.current.pop('t0')
+                self.current = None
+
+
+    def add(self, stage, seconds, cycle=None):
+        '''adds time spent in a stage to the current cycle, or to the given cycle'''
+        with self.lock:
+            self.totals.setdefault(stage, [0, 0.0])
+            self.totals[stage][0] += 1
+            self.totals[stage][1] += seconds
+            record = self.current
+            if cycle is not None and (record is None or record['cycle'] != cycle):
+                record = next((c for c in self.history if c['cycle'] == cycle), None)
+            if record is not None:
+                record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+
+
+    @contextmanager
+    def stage(self, stage, cycle=None):
+        '''context manager for timing a stage'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - start, cycle)
+
+
+    def cycles(self):
+        '''returns a copy of the recorded cycles, oldest first'''
+        with self.lock:
+            return [{'cycle': c['cycle'], 'start': c['start'], 'duration': c['duration'],
+                     'late': c['late'], 'stages': dict(c['stages'])} for c in self.history]
+
+
+    def summary(self):
+        '''returns a list of (stage, mean seconds per cycle, max seconds per cycle) over the recorded cycles'''
+        per_stage = {}
+        for c in self.cycles():
+            for stage, seconds in c['stages'].items():
+                per_stage.setdefault(stage, []).append(seconds)
+        return sorted((stage, sum(s) / len(s), max(s)) for stage, s in per_stage.items())
+
+
+    def prometheus(self):
+        '''returns the metrics in the prometheus text exposition format'''
+        with self.lock:
+            totals = {stage: tuple(v) for stage, v in self.totals.items()}
+            ncycles = self.ncycles
+            last = next((c for c in reversed(self.history) if c['duration'] is not None), None)
+            last = dict(last, stages=dict(last['stages'])) if last else None
+
+        lines = ['# HELP spiro_stage_seconds Time spent in each stage of the experiment cycles.',
+                 '# TYPE spiro_stage_seconds summary']
+        for stage, (count, seconds) in sorted(totals.items()):
+            lines.append('spiro_stage_seconds_sum{stage="%s"} %f' % (stage, seconds))
+            lines.append('spiro_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        lines += ['# HELP spiro_last_cycle_stage_seconds Time spent in each stage of the last completed cycle.',
+                  '# TYPE spiro_last_cycle_stage_seconds gauge']
+        if last:
+            for stage, seconds in sorted(last['stages'].items()):
+                lines.append('spiro_last_cycle_stage_seconds{stage="%s"} %f' % (stage, seconds))
+        lines += ['# HELP spiro_last_cycle_seconds Duration of the last completed cycle.',
+                  '# TYPE spiro_last_cycle_seconds gauge',
+                  'spiro_last_cycle_seconds %f' % (last['duration'] if last else 0),
+                  '# HELP spiro_cycles_total Number of cycles started.',
+                  '# TYPE spiro_cycles_total counter',
+                  'spiro_cycles_total %d' % ncycles]
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram(object):
+    '''a histogram of timing errors in seconds, with fixed buckets, cheap enough to
+       update for every motor step'''
+    buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+
+    def add(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+
+    def summary(self):
+        '''returns a dict with the count, mean and max value, and a list of (upper bound, count)
+           for each bucket, with None as the upper bound of the last bucket'''
+        with self.lock:
+            return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0,
+                    'max': self.max, 'buckets': list(zip(self.buckets + (None,), self.counts))}
+
+
+    def prometheus(self, name, help):
+        '''returns the histogram in the prometheus text exposition format'''
+        s = self.summary()
+        lines = ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % name]
+        cumulative = 0
+        for bound, count in s['buckets']:
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound if bound is not None else '+Inf', cumulative))
+        lines += ['%s_sum %f' % (name, s['mean'] * s['count']), '%s_count %d' % (name, s['count'])]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,45 @@
+# motion.py -
+#   acceleration-ramped motion profiles for the stepper motor
+#
+
+import math
+from functools import lru_cache
+
+profiles = ['trapezoid', 'scurve', 'constant']
+
+
+@lru_cache(maxsize=64)
+def stepDelays(steps, startspeed, maxspeed, accel, profile='trapezoid'):
+    '''returns a tuple with the time to wait after each step of a move, so that the
+       motor starts at startspeed, accelerates at accel (steps/s^2) up to maxspeed
+       (steps/s), and decelerates back to startspeed for the last step.
+       startspeed should be a speed at which the motor reliably starts from standstill.
+
+       the s-curve profile eases in and out of the acceleration phases, using a
+       smoothstep velocity curve over a 1.5x longer ramp, which gives the same peak
+       acceleration as the trapezoid profile but without abrupt changes in acceleration.'''
+    maxspeed = max(maxspeed, startspeed)
+    if profile == 'constant' or accel <= 0 or maxspeed == startspeed:
+        return (1.0 / maxspeed,) * steps
+
+    # number of steps needed to reach full speed
+    ramp = (maxspeed ** 2 - startspeed ** 2) / (2.0 * accel)
+    if profile == 'scurve':
+        ramp *= 1.5
+
+    delays = []
+    for i in range(steps):
+        # distance to the nearest end of the move; short moves never reach full speed
+        d = min(i, steps - 1 - i)
+        if profile == 'scurve':
+            x = min(d / ramp, 1.0)
+            v = startspeed + (maxspeed - startspeed) * x * x * (3 - 2 * x)
+        else:
+            v = min(math.sqrt(startspeed ** 2 + 2.0 * accel * d), maxspeed)
+        delays.append(1.0 / v)
+    return tuple(delays)
+
+
+def moveTime(steps, startspeed, maxspeed, accel, profile='trapezoid'):
+    '''returns the time in seconds that a move takes'''
+    return sum(stepDelays(steps, startspeed, maxspeed, accel, profile))
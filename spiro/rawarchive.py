@@ -0,0 +1,284 @@
+# rawarchive.py -
+#   append-only per-plate containers of raw RGB frames, for capturing now and
+#   converting to the usual image files later
+#
+#   file layout: a header, a fixed-size index with one entry per frame, and
+#   then the raw cropped frames, appended in capture order.
+#
+
+import os
+import mmap
+import time
+import struct
+import threading
+import numpy as np
+from PIL import Image
+from spiro.logger import log, debug
+from spiro.encoder import saveArgs, extension
+import spiro.manifest as manifest
+
+DAY = 1
+CONVERTED = 2
+
+# archives opened for writing by this process, by device and inode of their files. readers
+# open their own, so that no file stays open once it is no longer needed.
+archives = {}
+archives_lock = threading.Lock()
+
+
+def fileKey(st):
+    return (st.st_dev, st.st_ino)
+
+
+class RawArchive(object):
+    magic = b'SPIRORAW'
+    version = 1
+    # magic, version, width, height, capacity, count
+    header = struct.Struct('<8sIIIII')
+    # capture timestamp, flags, file name stem
+    entry = struct.Struct('<dB47s')
+
+    def __init__(self, path, res=None, capacity=None, readonly=False):
+        '''opens an existing archive, or creates a new one if a resolution and capacity are given'''
+        self.path = path
+        self.lock = threading.Lock()
+        if not readonly and not os.path.exists(path):
+            if not res or not capacity:
+                raise FileNotFoundError(path)
+            # created under another name, so that readers never see a partly written header
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(self.header.pack(self.magic, self.version, res[0], res[1], capacity, 0))
+                f.truncate(self.header.size + capacity * self.entry.size)
+            os.replace(tmp, path)
+        self.fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+        self.key = fileKey(os.fstat(self.fd))
+        magic, version, w, h, self.capacity, count = self.header.unpack(os.pread(self.fd, self.header.size, 0))
+        if magic != self.magic or version != self.version:
+            os.close(self.fd)
+            raise ValueError('Not a raw frame archive: ' + path)
+        self.res = (w, h)
+        self.framesize = w * h * 3
+        self.dataoffset = self.header.size + self.capacity * self.entry.size
+        # the header and index are memory mapped, and updated in place
+        self.index = mmap.mmap(self.fd, self.dataoffset, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def count(self):
+        return self.header.unpack_from(self.index)[5]
+
+
+    def full(self):
+        return self.count >= self.capacity
+
+
+    def stale(self):
+        '''returns true if the file of this archive has been removed or replaced since it was opened'''
+        try:
+            return fileKey(os.stat(self.path)) != self.key
+        except FileNotFoundError:
+            return True
+
+
+    def append(self, frame, timestamp, daytime, stem):
+        '''appends a (h, w, 3) frame, which may be a view into a larger buffer'''
+        with self.lock:
+            if self.stale():
+                raise FileNotFoundError('Raw frame archive has been removed: ' + self.path)
+            n = self.count
+            if n >= self.capacity:
+                raise RuntimeError('Raw frame archive is full: ' + self.path)
+            # write the frame row by row in as few system calls as possible, as the cropped
+            # frame is not contiguous in memory
+            rows = [frame[r] for r in range(frame.shape[0])]
+            iov_max = os.sysconf('SC_IOV_MAX')
+            os.lseek(self.fd, self.dataoffset + n * self.framesize, os.SEEK_SET)
+            for i in range(0, len(rows), iov_max):
+                os.writev(self.fd, rows[i:i+iov_max])
+            os.fdatasync(self.fd)
+            # only add the index entry once the frame is safely written
+            self.entry.pack_into(self.index, self.header.size + n * self.entry.size,
+                                 timestamp, DAY if daytime else 0, stem.encode('utf-8'))
+            self.header.pack_into(self.index, 0, self.magic, self.version, self.res[0], self.res[1],
+                                  self.capacity, n + 1)
+            self.index.flush()
+            return n
+
+
+    def entries(self):
+        '''returns a list of (number, timestamp, flags, stem) for all frames'''
+        result = []
+        for i in range(self.count):
+            ts, flags, stem = self.entry.unpack_from(self.index, self.header.size + i * self.entry.size)
+            result.append((i, ts, flags, stem.rstrip(b'\0').decode('utf-8')))
+        return result
+
+
+    def pending(self):
+        '''returns the entries that have not yet been converted'''
+        return [e for e in self.entries() if not e[2] & CONVERTED]
+
+
+    def find(self, stem):
+        '''returns the number of the unconverted frame with the given file name stem, or None'''
+        for i, ts, flags, s in self.pending():
+            if s == stem:
+                return i
+        return None
+
+
+    def frame(self, i):
+        '''returns a read-only (h, w, 3) array of a frame, backed by a memory mapping of the file'''
+        offset = self.dataoffset + i * self.framesize
+        # mappings must start at a page boundary
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        m = mmap.mmap(self.fd, offset - start + self.framesize, access=mmap.ACCESS_READ, offset=start)
+        return np.frombuffer(m, dtype=np.uint8, count=self.framesize, offset=offset - start) \
+                 .reshape((self.res[1], self.res[0], 3))
+
+
+    def markConverted(self, i):
+        with self.lock:
+            offset = self.header.size + i * self.entry.size
+            ts, flags, stem = self.entry.unpack_from(self.index, offset)
+            self.entry.pack_into(self.index, offset, ts, flags | CONVERTED, stem)
+            self.index.flush()
+
+
+    def close(self):
+        self.index.close()
+        os.close(self.fd)
+
+
+def archivePath(expdir, plate_no):
+    return os.path.join(expdir, 'plate' + str(plate_no + 1) + '.raw')
+
+
+def get(path, res=None, capacity=None):
+    '''returns the shared archive object for writing to the archive at a path, opening or creating
+       it if necessary. an archive whose file has since been removed or replaced is not used again.'''
+    with archives_lock:
+        try:
+            archive = archives.get(fileKey(os.stat(path)))
+        except FileNotFoundError:
+            archive = None
+        if archive is None or archive.stale():
+            # closes any archives that used to be at this path
+            evict(path)
+            archive = RawArchive(path, res, capacity)
+            archives[archive.key] = archive
+        return archive
+
+
+def reader(path):
+    '''opens an archive for reading. the archive is not shared, and must be closed by the caller.'''
+    return RawArchive(path, readonly=True)
+
+
+def evict(path):
+    '''closes the shared archives that were opened at a path. call with archives_lock held.'''
+    path = os.path.abspath(path)
+    for key, archive in list(archives.items()):
+        if os.path.abspath(archive.path) == path:
+            del archives[key]
+            archive.close()
+
+
+def closeDir(expdir):
+    '''closes the shared archives of an experiment directory, e.g. before it is removed'''
+    with archives_lock:
+        for i in range(4):
+            evict(archivePath(expdir, i))
+
+
+def release(path):
+    '''closes an archive, and removes it if all its frames have been converted'''
+    with archives_lock:
+        evict(path)
+    try:
+        with reader(path) as archive:
+            done = archive.count > 0 and not archive.pending()
+    except FileNotFoundError:
+        return
+    if done:
+        debug("All frames in %s converted, removing it." % path)
+        os.remove(path)
+
+
+def plateArchives(expdir):
+    '''returns a list of (plate directory, archive path) for the archives in an experiment directory'''
+    result = []
+    for i in range(4):
+        path = archivePath(expdir, i)
+        if os.path.exists(path):
+            result.append((os.path.join(expdir, 'plate' + str(i + 1)), path))
+    return result
+
+
+def unconverted(expdir, plate):
+    '''returns the stems of unconverted frames for a plate directory name, e.g. "plate1"'''
+    try:
+        with reader(os.path.join(expdir, plate + '.raw')) as archive:
+            return [e[3] for e in archive.pending()]
+    except FileNotFoundError:
+        return []
+
+
+def encode(archive, i, filename, fmt='png', level=6):
+    '''encodes a frame from an archive to an image file, or to a file-like object'''
+    im = Image.frombuffer('RGB', archive.res, archive.frame(i), 'raw', 'RGB', 0, 1)
+    try:
+        im.save(filename, **saveArgs(fmt, level))
+    finally:
+        im.close()
+
+
+def lookup(path):
+    '''finds the unconverted frame that will end up at the given image path. returns a tuple
+       of (archive, frame number), or None. the archive is opened for reading (see reader()).'''
+    platedir, name = os.path.split(path)
+    stem = os.path.splitext(name)[0]
+    try:
+        archive = reader(platedir + '.raw')
+    except FileNotFoundError:
+        return None
+    i = archive.find(stem)
+    if i is None:
+        archive.close()
+        return None
+    return archive, i
+
+
+def convertDir(expdir, fmt='png', level=6):
+    '''converts all unconverted frames in an experiment directory, and removes
+       the archives afterwards. returns the number of converted frames.'''
+    n = 0
+    records = None
+    if os.path.exists(os.path.join(expdir, manifest.filename)):
+        records = manifest.Manifest(expdir)
+    try:
+        for platedir, path in plateArchives(expdir):
+            archive = get(path)
+            for i, ts, flags, stem in archive.pending():
+                filename = os.path.join(platedir, stem + extension(fmt))
+                start = time.monotonic()
+                encode(archive, i, filename, fmt, level)
+                archive.markConverted(i)
+                n += 1
+                log("Converted %s in %.1f s." % (filename, time.monotonic() - start))
+                if records:
+                    records.convert(filename, os.path.getsize(filename), time.monotonic() - start)
+            release(path)
+    finally:
+        if records:
+            records.close()
+    return n
@@ -0,0 +1,82 @@
+# scheduler.py -
+#   drift-free scheduling of experiment cycles
+#
+
+import math
+import time
+import threading
+from spiro.logger import log, debug
+
+# what to do when a cycle overruns into the next one:
+#   skip     - drop the missed cycles, and continue on the original schedule
+#   catchup  - run the missed cycles back to back until the schedule is caught up
+#   shift    - start the next cycle immediately, and shift the schedule to follow it
+policies = ['skip', 'catchup', 'shift']
+
+
+class Scheduler(object):
+    '''plans cycle start times as monotonic deadlines at fixed intervals from the
+       experiment start, so that the interval does not drift with the cycle duration
+       or with changes to the system clock. waiting is done on an event, so that
+       stop() takes effect immediately.'''
+    def __init__(self, interval, duration, policy='skip'):
+        self.interval = interval
+        self.policy = policy if policy in policies else 'skip'
+        self.stop_event = threading.Event()
+        self.start = time.monotonic()
+        self.end = self.start + duration
+        self.deadline = self.start
+        self.ncycles = 0
+        self.nskipped = 0
+        self.late = 0
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+    def remaining(self):
+        '''returns the number of seconds until the next cycle is due'''
+        return min(self.deadline, self.end) - time.monotonic()
+
+
+    def waitNext(self):
+        '''waits until the next cycle is due. returns the planned start time of the
+           cycle, relative to the experiment start, or None if the experiment is over.'''
+        self.stop_event.wait(max(0, self.remaining()))
+        if self.stopped() or self.deadline >= self.end or time.monotonic() >= self.end:
+            return None
+        self.late = time.monotonic() - self.deadline
+        planned = self.deadline - self.start
+        debug("Cycle %d: planned start %.1f s, actual start %.1f s (%.2f s late)."
+              % (self.ncycles + 1, planned, planned + self.late, self.late))
+        return planned
+
+
+    def cycleDone(self):
+        '''plans the next cycle deadline after a cycle has finished'''
+        self.ncycles += 1
+        self.deadline += self.interval
+        now = time.monotonic()
+        late = now - self.deadline
+        if late <= 0:
+            return
+        if self.policy == 'skip':
+            missed = math.ceil(late / self.interval)
+            self.deadline += missed * self.interval
+            self.nskipped += missed
+            log("Cycle overran the interval by %.1f s, skipping %d cycles." % (late, missed))
+        elif self.policy == 'shift':
+            log("Cycle overran the interval by %.1f s, shifting schedule." % late)
+            self.deadline = now
+        else:
+            log("Cycle overran the interval by %.1f s, catching up." % late)
+
+
+    def cyclesLeft(self):
+        '''returns the number of cycles remaining on the schedule'''
+        return max(0, math.ceil((self.end - self.deadline) / self.interval))
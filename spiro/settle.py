@@ -0,0 +1,72 @@
+# settle.py -
+#   detects when the imaging stage has come to rest after moving
+#
+
+import time
+import numpy as np
+from collections import deque
+from spiro.logger import debug
+
+
+class SettleDetector(object):
+    '''waits for the stage to settle by comparing consecutive low-resolution frames
+       from the video port. the stage is considered stable once the mean absolute
+       difference in luminance between two frames drops below a threshold, or when
+       the timeout is reached. in 'fixed' mode, it just sleeps for a fixed time.
+       the settings are read from the config for every wait, so that changes apply right away.'''
+    # a multiple of 32x16, so that picamera does not pad the yuv planes
+    size = (160, 128)
+
+    def __init__(self, cam, cfg):
+        self.cam = cam
+        self.cfg = cfg
+        w, h = self.size
+        # preallocated buffers, reused for every frame
+        self.frame = np.empty(w * h * 3 // 2, dtype=np.uint8)
+        self.luma = self.frame[:w * h].reshape((h, w))
+        self.prev = np.empty((h, w), dtype=np.int16)
+        self.diff = np.empty((h, w), dtype=np.int16)
+        # (seconds waited, whether the stage settled before the timeout) of recent waits
+        self.history = deque(maxlen=100)
+
+
+    def wait(self, fixed=0.5):
+        '''waits until the stage is stable. returns the number of seconds waited.'''
+        if self.cfg.get('settlemode') != 'adaptive':
+            time.sleep(fixed)
+            return fixed
+        threshold = self.cfg.get('settlethreshold')
+        timeout = self.cfg.get('settletimeout')
+
+        start = time.monotonic()
+        settled = False
+        motion = None
+        n = 0
+        for foo in self.cam.capture_continuous(self.frame, 'yuv', use_video_port=True, resize=self.size):
+            if n > 0:
+                np.subtract(self.luma, self.prev, out=self.diff)
+                np.abs(self.diff, out=self.diff)
+                motion = self.diff.mean()
+                if motion < threshold:
+                    settled = True
+                    break
+            if time.monotonic() - start >= timeout:
+                break
+            self.prev[:] = self.luma
+            n += 1
+
+        elapsed = time.monotonic() - start
+        self.history.append((elapsed, settled))
+        if settled:
+            debug("Stage settled after %.2f s (%d frames, motion %.2f)." % (elapsed, n + 1, motion))
+        else:
+            debug("Stage did not settle within %.1f s (motion %s)." % (timeout, motion))
+        return elapsed
+
+
+    def stats(self):
+        '''returns (mean, max, number of timeouts) for the recorded waits'''
+        if not self.history:
+            return None
+        times = [t for t, settled in self.history]
+        return sum(times) / len(times), max(times), sum(1 for t, settled in self.history if not settled)
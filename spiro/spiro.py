@@ -13,6 +13,7 @@ from spiro.hwcontrol import HWControl
 from spiro.logger import log, debug
 import spiro.failsafe as failsafe
 import spiro.hostapd as hostapd
+import spiro.rawarchive as rawarchive
 import spiro.webui as webui
 import argparse
 import signal
@@ -37,6 +38,8 @@ parser.add_argument('--enable-hotspot', action="store_true", dest="enable_ap",
                     help="enables the wi-fi hotspot")
 parser.add_argument('--disable-hotspot', action="store_true", dest="disable_ap",
                     help="disables the wi-fi hotspot")
+parser.add_argument('--convert-raw', metavar='DIR', dest='convert_raw',
+                    help="converts raw frames archived during an experiment in DIR to image files")
 parser.add_argument('--disable-rotation', action="store_true", dest="disable_rotation",
                     help="disables camera rotation (use with non-rotated camera house)")
 
@@ -142,9 +145,12 @@ def main():
         hostapd.stop_ap()
     if options.show_version:
         print(f'SPIRO software version {cfg.version}')
+    if options.convert_raw:
+        n = rawarchive.convertDir(os.path.abspath(options.convert_raw), cfg.get('imageformat'), cfg.get('compresslevel'))
+        print(f'Converted {n} raw frames.')
     if any([options.reset, options.resetpw, options.install, options.toggle_debug,
             options.enable_ap, options.disable_ap, options.disable_rotation,
-            options.show_version]):
+            options.show_version, options.convert_raw]):
         sys.exit()
 
     # no options given, go ahead and start web ui
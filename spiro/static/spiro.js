@@ -62,3 +62,57 @@ function tryCalibration() {
     calib = document.getElementById('calibration');
     bgGet('/findstart/' + calib.value);
 }
+
+function browseImages(dir, query, id, moreid) {
+    list = document.getElementById(id);
+    more = document.getElementById(moreid);
+    params = new URLSearchParams(query);
+    loading = false;
+    function loadPage() {
+        if (loading || params.get('cursor') === '') return;
+        loading = true;
+        fetch('/browse/' + encodeURIComponent(dir) + '/images?' + params.toString())
+            .then(function(response) { return response.json(); })
+            .then(function(page) {
+                page.images.forEach(function(image) {
+                    item = document.createElement('li');
+                    item.className = 'thumb';
+                    link = document.createElement('a');
+                    link.href = '/view/' + encodeURIComponent(dir) + '/' + image.path;
+                    link.className = 'browse';
+                    img = document.createElement('img');
+                    img.src = '/thumb/' + encodeURIComponent(dir) + '/' + image.path;
+                    img.loading = 'lazy';
+                    img.alt = '';
+                    link.appendChild(img);
+                    link.appendChild(document.createElement('br'));
+                    link.appendChild(document.createTextNode(image.name));
+                    item.appendChild(link);
+                    list.appendChild(item);
+                });
+                params.set('cursor', page.next || '');
+                more.innerHTML = page.next ? 'Loading...' : (list.childNodes.length ? '' : 'No images.');
+                loading = false;
+                // the page may not be full yet
+                if (page.next && more.getBoundingClientRect().top < window.innerHeight) loadPage();
+            });
+    }
+    new IntersectionObserver(function(entries) {
+        if (entries[0].isIntersecting) loadPage();
+    }, {rootMargin: '800px'}).observe(more);
+}
+
+function followLog(url, id) {
+    log = document.getElementById(id);
+    source = new EventSource(url);
+    source.onmessage = function(event) {
+        atBottom = window.innerHeight + window.scrollY >= document.body.scrollHeight - 10;
+        log.appendChild(document.createTextNode(event.data + "\n"));
+        while (log.childNodes.length > 2000) {
+            log.removeChild(log.firstChild);
+        }
+        if (atBottom) {
+            window.scrollTo(0, document.body.scrollHeight);
+        }
+    };
+}
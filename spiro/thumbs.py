@@ -0,0 +1,226 @@
+# thumbs.py -
+#   downscaled copies of the captured images for the file browser. thumbnails are kept in
+#   a hidden cache directory in each experiment directory, made on first request, and ahead
+#   of time by a background thread that pauses between images.
+#
+
+import os
+import time
+import threading
+from io import BytesIO
+from collections import OrderedDict, deque
+from PIL import Image, features
+from spiro.config import Config
+from spiro.logger import log, debug
+import spiro.rawarchive as rawarchive
+
+# thumbnail sizes that may be requested, as the length of the longer side in pixels
+sizes = (160, 320, 640)
+default_size = 320
+# file extension and PIL save() arguments for each thumbnail format
+formats = {
+    'jpeg': ('.jpg', {'format': 'JPEG', 'quality': 80}),
+    'webp': ('.webp', {'format': 'WEBP', 'quality': 75, 'method': 4}),
+}
+# the format made ahead of time; the other one is only made on request
+default_format = 'webp' if features.check('webp') else 'jpeg'
+cachedir = '.thumbs'
+# the largest number of images waiting for a thumbnail, and of those that come with a copy
+# of the image to make it from, which are kept in memory until then
+max_queued = 20000
+max_sources = 8
+# the time the background thread waits after each thumbnail, in seconds. it shares the
+# interpreter with the motor and capture threads, so it must not run flat out; a lower
+# scheduling priority would let it hold up those threads while it holds the interpreter lock.
+pause = 0.1
+
+cfg = Config()
+caches = {}
+inflight = {}
+lock = threading.Lock()
+queue = deque()
+queued = set()
+sources = 0
+pending = threading.Condition(lock)
+thread = None
+
+
+def thumbPath(image, size=default_size, fmt=default_format):
+    '''returns the path of the thumbnail of an image in experiment/plateN/'''
+    platedir, name = os.path.split(image)
+    expdir, plate = os.path.split(platedir)
+    return os.path.join(expdir, cachedir, plate, os.path.splitext(name)[0] + '.%d%s' % (size, formats[fmt][0]))
+
+
+class Cache(object):
+    '''the thumbnail cache of one experiment, which is kept below a size limit by removing
+       the least recently used thumbnails. the order of use is only kept in memory, so that
+       reading a thumbnail does not cause a write to the sd card; on startup, it is taken
+       from the modification times of the files.'''
+    def __init__(self, path):
+        self.path = path
+        self.entries = OrderedDict()
+        self.total = 0
+        found = []
+        for plate in os.scandir(path) if os.path.isdir(path) else []:
+            if plate.is_dir():
+                for entry in os.scandir(plate.path):
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        st = entry.stat()
+                        found.append((st.st_mtime, entry.path, st.st_size))
+        for mtime, path, size in sorted(found):
+            self.entries[path] = size
+            self.total += size
+
+
+    def touch(self, path):
+        if path in self.entries:
+            self.entries.move_to_end(path)
+
+
+    def add(self, path, size, limit):
+        '''records a new thumbnail, and returns the paths of the thumbnails to remove'''
+        self.total += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+        evicted = []
+        while self.total > limit and len(self.entries) > 1:
+            old, oldsize = self.entries.popitem(last=False)
+            self.total -= oldsize
+            evicted.append(old)
+        return evicted
+
+
+def cacheFor(image):
+    '''returns the cache of the experiment an image belongs to. call with the lock held.'''
+    path = os.path.join(os.path.dirname(os.path.dirname(image)), cachedir)
+    if path not in caches:
+        caches[path] = Cache(path)
+    return caches[path]
+
+
+def fresh(image, thumb):
+    '''returns true if the thumbnail exists, and is not older than its image'''
+    try:
+        mtime = os.stat(thumb).st_mtime
+    except FileNotFoundError:
+        return False
+    try:
+        return mtime >= os.stat(image).st_mtime
+    except FileNotFoundError:
+        # the image is still in a raw archive, which does not change
+        return True
+
+
+def get(image, size=default_size, fmt=default_format):
+    '''returns the path of an up-to-date thumbnail of an image, making it first if needed.
+       raises FileNotFoundError if there is no such image.'''
+    thumb = thumbPath(image, size, fmt)
+    if fresh(image, thumb):
+        with lock:
+            cacheFor(image).touch(thumb)
+        return thumb
+    make(image, size, fmt)
+    return thumb
+
+
+def openImage(image, size, source=None):
+    '''opens an image for downscaling, from the given encoded data, the image file, or the
+       raw archive it is waiting in'''
+    if source is not None:
+        return Image.open(BytesIO(source))
+    try:
+        im = Image.open(image)
+        # lets jpeg images be decoded at a lower resolution
+        im.draft('RGB', (size, size))
+        return im
+    except FileNotFoundError:
+        found = rawarchive.lookup(image)
+        if not found:
+            raise
+        archive, i = found
+        with archive:
+            # every fourth pixel is plenty for a thumbnail, and avoids reading most of the frame
+            return Image.fromarray(archive.frame(i)[::4, ::4].copy())
+
+
+def make(image, size=default_size, fmt=default_format, source=None):
+    '''makes a thumbnail of an image, optionally from an encoded copy of it (source), such as
+       the preview made at capture time. concurrent requests for the same thumbnail wait for
+       the first one to finish.'''
+    thumb = thumbPath(image, size, fmt)
+    with lock:
+        event = inflight.get(thumb)
+        if event is None:
+            inflight[thumb] = threading.Event()
+    if event is not None:
+        event.wait()
+        if not os.path.exists(thumb):
+            raise FileNotFoundError(image)
+        return thumb
+
+    try:
+        im = openImage(image, size, source)
+        try:
+            im.thumbnail((size, size), reducing_gap=3.0)
+            if im.mode != 'RGB':
+                im = im.convert('RGB')
+            os.makedirs(os.path.dirname(thumb), exist_ok=True)
+            # written under a temporary name, so that a half-written thumbnail is never served
+            tmp = thumb + '.tmp'
+            im.save(tmp, **formats[fmt][1])
+            os.replace(tmp, thumb)
+        finally:
+            im.close()
+        with lock:
+            evicted = cacheFor(image).add(thumb, os.path.getsize(thumb), cfg.get('thumbcachesize') * 1024**2)
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            debug("Removed %d thumbnails from the cache." % len(evicted))
+    finally:
+        with lock:
+            inflight.pop(thumb).set()
+    return thumb
+
+
+def add(image, source=None):
+    '''queues an image for making its thumbnail in the background, optionally from an encoded
+       downscaled copy of it (see make()). the copy is left out if too many are queued already.'''
+    global thread, sources
+    with lock:
+        if image in queued or len(queue) >= max_queued:
+            return
+        if source is not None:
+            if sources >= max_sources:
+                source = None
+            else:
+                sources += 1
+        queue.append((image, source))
+        queued.add(image)
+        if thread is None:
+            thread = threading.Thread(target=worker, name='thumbnailer', daemon=True)
+            thread.start()
+        pending.notify()
+
+
+def worker():
+    global sources
+    while True:
+        with lock:
+            pending.wait_for(lambda: queue)
+            image, source = queue.popleft()
+            queued.discard(image)
+            if source is not None:
+                sources -= 1
+        try:
+            if fresh(image, thumbPath(image)):
+                continue
+            make(image, source=source)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log("Could not make thumbnail of %s: %s" % (image, e))
+        time.sleep(pause)
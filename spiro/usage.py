@@ -0,0 +1,147 @@
+# usage.py -
+#   disk usage index of the experiment directories, for the file manager. the index of each
+#   experiment is kept in a small file in its directory, updated by the experimenter as it
+#   writes images, and checked against the modification times of the directories, so that
+#   the directories only need to be scanned again if something else has changed them.
+#
+
+import os
+import json
+import time
+import threading
+from spiro.logger import debug
+import spiro.rawarchive as rawarchive
+
+indexfile = '.usage'
+# the least time between writes of the index of a running experiment, in seconds
+save_interval = 60
+
+indexes = {}
+lock = threading.Lock()
+
+
+def stamp(expdir):
+    '''returns the modification times of an experiment directory and its plate directories,
+       which change whenever a file is added to or removed from them'''
+    result = []
+    for path in [expdir] + [os.path.join(expdir, 'plate' + str(i + 1)) for i in range(4)]:
+        try:
+            result.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            result.append(0)
+    return result
+
+
+class Usage(object):
+    '''the number of images, bytes used and last capture time of one experiment'''
+    def __init__(self, expdir):
+        self.expdir = expdir
+        self.files = 0
+        self.bytes = 0
+        self.last = 0
+        self.stamp = None
+        self.saved = 0
+        self.dirty = False
+
+
+    def scan(self):
+        '''counts the images and bytes in the plate directories and raw archives'''
+        files = size = 0
+        last = 0
+        self.stamp = stamp(self.expdir)
+        for i in range(4):
+            plate = 'plate' + str(i + 1)
+            for entry in os.scandir(os.path.join(self.expdir, plate)):
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                    st = entry.stat(follow_symlinks=False)
+                    files += 1
+                    # blocks rather than length, as for du
+                    size += st.st_blocks * 512
+                    last = max(last, st.st_mtime)
+            archive = rawarchive.archivePath(self.expdir, i)
+            if os.path.exists(archive):
+                # raw archives are preallocated sparse files
+                size += os.stat(archive).st_blocks * 512
+                files += len(rawarchive.unconverted(self.expdir, plate))
+        self.files, self.bytes, self.last = files, size, last
+        self.dirty = True
+
+
+    def load(self):
+        '''reads the saved index, if there is one'''
+        try:
+            with open(os.path.join(self.expdir, indexfile)) as f:
+                data = json.load(f)
+            self.files, self.bytes, self.last, self.stamp = data['files'], data['bytes'], data['last'], data['stamp']
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+    def save(self):
+        '''writes the index. the file is rewritten in place, so that saving does not change the
+           stamp; a file left incomplete by a crash only means that the directories are scanned again.'''
+        path = os.path.join(self.expdir, indexfile)
+        try:
+            if not os.path.exists(path):
+                # creating the file changes the experiment directory
+                open(path, 'w').close()
+                self.stamp[0] = os.stat(self.expdir).st_mtime_ns
+            with open(path, 'w') as f:
+                json.dump({'files': self.files, 'bytes': self.bytes, 'last': self.last, 'stamp': self.stamp}, f)
+        except OSError as e:
+            debug("Could not save the disk usage index of %s: %s" % (self.expdir, e))
+            return
+        self.saved = time.monotonic()
+        self.dirty = False
+
+
+def indexFor(expdir):
+    '''returns the index of an experiment, loading it if needed. call with the lock held.'''
+    expdir = os.path.abspath(expdir)
+    if expdir not in indexes:
+        index = Usage(expdir)
+        index.load()
+        indexes[expdir] = index
+    return indexes[expdir]
+
+
+def get(expdir):
+    '''returns the up-to-date index of an experiment, scanning it only if the directories have
+       changed since the index was last updated'''
+    with lock:
+        index = indexFor(expdir)
+        if index.stamp != stamp(index.expdir):
+            start = time.perf_counter()
+            index.scan()
+            debug("Scanned %s for the file manager in %.2f s." % (expdir, time.perf_counter() - start))
+        if index.dirty:
+            index.save()
+        return index
+
+
+def add(path, size, captured=None, new=True):
+    '''records an image written by the experimenter. size is the number of bytes it adds to the
+       experiment; new is false for images converted from a raw archive, which were already counted.'''
+    platedir = os.path.dirname(os.path.abspath(path))
+    expdir = os.path.dirname(platedir)
+    with lock:
+        index = indexFor(expdir)
+        if index.stamp is None:
+            # no index yet; the next get() makes one from scratch
+            return
+        index.files += 1 if new else 0
+        index.bytes += size
+        index.last = max(index.last, captured or time.time())
+        # the plate directory has changed only by this file, as far as we know
+        index.stamp[int(os.path.basename(platedir)[len('plate'):])] = os.stat(platedir).st_mtime_ns
+        index.dirty = True
+        if time.monotonic() - index.saved > save_interval:
+            index.save()
+
+
+def flush(expdir):
+    '''saves the index of an experiment, if it has changed'''
+    with lock:
+        index = indexes.get(os.path.abspath(expdir))
+        if index is not None and index.dirty and index.stamp is not None:
+            index.save()
@@ -9,20 +9,55 @@ import time
 import shutil
 import signal
 import hashlib
+import mimetypes
 import subprocess
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock
 
 from waitress import serve
-from flask import Flask, render_template, Response, request, redirect, url_for, session, flash, abort
+from flask import Flask, render_template, Response, request, redirect, url_for, session, flash, abort, jsonify
 
 import spiro.hostapd as hostapd
+import spiro.encoder as encoder
+import spiro.rawarchive as rawarchive
+import spiro.logview as logview
+from spiro.logview import parseTime
+import spiro.httpcache as httpcache
+import spiro.thumbs as thumbs
+import spiro.usage as usage
+import spiro.manifest as manifest
+import spiro.zipstream as zipstream
 from spiro.config import Config
 from spiro.logger import log, debug
 from spiro.experimenter import Experimenter
+from spiro.settle import SettleDetector
+from spiro.broadcast import Broadcaster, FrameStore
 
 app = Flask(__name__)
+mimetypes.add_type('image/webp', '.webp')
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
+static_files = httpcache.StaticFiles(app.static_folder)
+# part of the etags of the previews, which are numbered from zero again whenever the program starts
+preview_epoch = '%x' % int(time.time())
+# captured images do not change, but may be deleted, so browsers revalidate them after a day
+view_cache = 'private, max-age=86400'
+
+@app.url_defaults
+def static_version(endpoint, values):
+    '''adds the file version to the urls of static files, so that browsers can cache them for long'''
+    if endpoint == 'static' and 'filename' in values:
+        values.setdefault('v', static_files.version(values['filename']))
+
+
+def static(filename):
+    return static_files.serve(filename)
+
+app.view_functions['static'] = static
+
+# each zip export keeps a waitress thread busy, so their number is limited
+max_exports = 2
+exports = 0
+exports_lock = Lock()
 
 class Rotator(Thread):
     def __init__(self, value):
@@ -34,31 +69,14 @@ class Rotator(Thread):
         try:
             hw.motorOn(True)
             time.sleep(0.5)
-            hw.halfStep(self.value, 0.03)
-            time.sleep(0.5)
+            hw.halfStep(self.value)
+            # keep the motor powered until the stage has come to rest
+            settler.wait()
         finally:
             hw.motorOn(False)
             lock.release()
 
 
-class StreamingOutput(object):
-    def __init__(self):
-        self.frame = None
-        self.buffer = io.BytesIO()
-        self.condition = Condition()
-
-    def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
-            with self.condition:
-                self.frame = self.buffer.getvalue()
-                self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
-
-
 class StillOutput(object):
     def __init__(self):
         self.frame = None
@@ -114,7 +132,8 @@ def check_route_access():
         return redirect(url_for('newpass'))
     if any([request.endpoint == 'static',
             checkPass(session.get('password')),
-            getattr(app.view_functions[request.endpoint], 'is_public', False)]):
+            getattr(app.view_functions[request.endpoint], 'is_public', False),
+            request.endpoint == 'metrics' and cfg.get('publicmetrics')]):
         if experimenter.running and getattr(app.view_functions[request.endpoint], 'not_while_running', False):
             return redirect(url_for('empty'))
         return  # Access granted
@@ -272,21 +291,29 @@ def findstart(value=None):
     return redirect(url_for('index'))
 
 
-def liveGen():
-    while True:
-        with liveoutput.condition:            
-            got_frame = liveoutput.condition.wait(timeout=0.1)
-        if got_frame:
-            yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + liveoutput.frame + b'\r\n')
-        else:
-            # failed to acquire an image; return nothing instead of waiting
-            yield b''
-            
-
 @not_while_running
 @app.route('/stream.mjpg')
 def liveStream():
-    return Response(liveGen(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    '''the live view as an mjpeg stream. the frame rate can be capped with ?fps=n.'''
+    fps = request.args.get('fps', type=float)
+    return Response(broadcaster.stream(request.remote_addr, fps if fps and fps > 0 else None),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@not_while_running
+@app.route('/stream/frame.jpg')
+def liveFrame():
+    '''the newest live view frame, as a single image'''
+    frame = liveoutput.snapshot()
+    if frame is None:
+        abort(503)
+    return Response(frame, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+
+
+@app.route('/stream/stats')
+def stream_stats():
+    '''frames delivered and dropped for each live view client'''
+    return jsonify(broadcaster.stats())
 
 
 @app.route('/nightstill.png')
@@ -314,8 +341,11 @@ def lastCapture(num):
             return redirect(url_for('static', filename='empty.png'))
         else:
             try:
-                with open(experimenter.last_captured[num], 'rb') as f:
-                    return Response(f.read(), mimetype="image/png")
+                if not os.path.exists(experimenter.last_captured[num]):
+                    found = rawarchive.lookup(experimenter.last_captured[num])
+                    if found:
+                        return archivedResponse(*found)
+                return httpcache.sendFile(experimenter.last_captured[num])
             except Exception as e:
                 print("Could not read last captured image:", e)
                 return redirect(url_for('static', filename='empty.png'))
@@ -330,8 +360,12 @@ def preview(num):
     else:
         experimenter.preview_lock.acquire()
         try:
-            experimenter.preview[num].seek(0)
-            return Response(experimenter.preview[num].read(), mimetype="image/jpeg")
+            etag = 'p%s-%d-%d' % (preview_epoch, num, experimenter.preview_seq[num])
+            response = httpcache.notModified(etag)
+            if response is None:
+                experimenter.preview[num].seek(0)
+                response = httpcache.headers(Response(experimenter.preview[num].read(), mimetype="image/jpeg"), etag)
+            return response
         finally:
             experimenter.preview_lock.release()
 
@@ -381,6 +415,7 @@ def experiment():
                 else: experimenter.delay = 60
                 if request.form.get('directory'): experimenter.dir = os.path.expanduser(os.path.join('~', request.form['directory'].replace('/', '-')))
                 else: experimenter.dir = os.path.expanduser('~')
+                experimenter.rawmode = bool(request.form.get('rawmode'))
                 setLive('off')
                 zoomer.set(roi=1.0)
                 log("Starting new experiment.")
@@ -403,7 +438,26 @@ def experiment():
                            starttime=time.ctime(experimenter.starttime), delay=experimenter.delay,
                            endtime=time.ctime(experimenter.endtime), diskspace=diskspace, duration=experimenter.duration,
                            status=experimenter.status, nshots=experimenter.nshots + 1, diskreq=diskreq, name=cfg.get('name'),
-                           defname=experimenter.getDefName())
+                           defname=experimenter.getDefName(), failed=experimenter.writer.nfailed,
+                           timings=experimenter.timer.summary(),
+                           settle=experimenter.settler.stats() if experimenter.settler else None,
+                           jitter=hw.jitter.summary(),
+                           errors=list(experimenter.writer.errors))
+
+
+@app.route('/metrics')
+def metrics():
+    '''cycle stage timings and motor step jitter, for scraping by prometheus. requires a login,
+       unless publicmetrics is set in the config.'''
+    text = experimenter.timer.prometheus() + \
+        hw.jitter.prometheus('spiro_step_jitter_seconds', 'Time motor steps were made after their deadline.')
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/history')
+def metrics_history():
+    '''stage timings of the most recent cycles'''
+    return jsonify(experimenter.timer.cycles())
 
 
 @not_while_running
@@ -447,18 +501,20 @@ def exposure(time):
     ds=None
 
     if request.method == 'POST':
+        values = {}
         shutter = request.form.get('shutter')
         if shutter:
             shutter = int(shutter)
             shutter = max(10, min(shutter, 1000))
-            cfg.set(time + 'shutter', shutter)
+            values[time + 'shutter'] = shutter
             flash("New shutter speed for " + time + " images: 1/" + str(shutter))
         iso = request.form.get('iso')
         if iso:
             iso = int(iso)
             iso = max(50, min(iso, 800))
-            cfg.set(time + 'iso', iso)
+            values[time + 'iso'] = iso
             flash("New ISO for " + time + " images: " + str(shutter))
+        cfg.set_many(values)
 
         exposureMode(time)
         grabExposure(time)
@@ -489,7 +545,8 @@ def calibrate():
             flash("New value for start position: " + str(value))
     exposureMode('auto')
     setLive('on')
-    return render_template('calibrate.html', calibration=cfg.get('calibration'), name=cfg.get('name'))
+    return render_template('calibrate.html', calibration=cfg.get('calibration'), name=cfg.get('name'),
+                           homing=hw.homingStats())
 
 
 @not_while_running
@@ -520,12 +577,23 @@ def shutdown():
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     if request.method == 'POST':
+        # all settings are saved at once, with a single write of the config file
+        values = {}
         if request.form.get('name'):
-            cfg.set('name', request.form.get('name'))
+            values['name'] = request.form.get('name')
+        if request.form.get('imageformat') in encoder.formats:
+            values['imageformat'] = request.form.get('imageformat')
+        if request.form.get('compresslevel'):
+            values['compresslevel'] = max(0, min(int(request.form.get('compresslevel')), 9))
+        if request.form.get('encodercores'):
+            values['encodercores'] = max(1, min(int(request.form.get('encodercores')), os.cpu_count() or 1))
+        cfg.set_many(values)
     ssid, passwd = hostapd.get_ssid()
     return render_template('settings.html', name=cfg.get('name'), running=experimenter.running, version=cfg.version,
                            debug=cfg.get('debug'), ip_addr=get_external_ip(), hotspot_ready=hostapd.is_ready(),
-                           hotspot_enabled=hostapd.is_enabled(), ssid=ssid, passwd=passwd, rotation=cfg.get('rotated_camera'))
+                           hotspot_enabled=hostapd.is_enabled(), ssid=ssid, passwd=passwd, rotation=cfg.get('rotated_camera'),
+                           formats=encoder.formats, imageformat=cfg.get('imageformat'), compresslevel=cfg.get('compresslevel'),
+                           encodercores=cfg.get('encodercores'), maxcores=os.cpu_count() or 1)
 
 
 @not_while_running
@@ -547,22 +615,80 @@ def file_browser():
 
     for entry in os.scandir(dir):
         if entry.is_dir() and os.path.dirname(entry.path) == dir and not entry.name.startswith('.') \
-                and all(os.path.exists(os.path.join(entry.path, f'plate{i+1}')) for i in range(4)):
-            du = subprocess.check_output(['/usr/bin/du','-s', entry.path]).split()[0].decode('utf-8')
-            dirs.append((entry.name, round(int(du)/1024**2, 1)))
+                and isExperiment(entry.path):
+            index = usage.get(entry.path)
+            last = time.strftime('%Y-%m-%d %H:%M', time.localtime(index.last)) if index.last else None
+            dirs.append((entry.name, round(index.bytes / 1024**3, 1), index.files, last))
     return render_template('filemanager.html', dirs=sorted(dirs), diskspace=diskspace, name=cfg.get('name'), running=experimenter.running)
 
 
 @app.route('/get/<exp_dir>.zip')
 def make_zipfile(exp_dir):
-    'creates a zipfile on the fly, and streams it to the client'
+    '''creates a zipfile on the fly, and streams it to the client. the images may be selected
+       with the same query parameters as for browse_images().'''
+    global exports
     dir = os.path.expanduser('~')
     zip_dir = os.path.abspath(os.path.join(dir, exp_dir))
-    if verify_dir(zip_dir):
-        p = subprocess.Popen(['/usr/bin/zip', '-r', '-0', '-', os.path.basename(zip_dir)], stdout=subprocess.PIPE, cwd=dir)
-        return Response(stream_popen(p), mimetype='application/zip')
-    else:
+    if not verify_dir(zip_dir) or not isExperiment(zip_dir):
         abort(404)
+    plate, daytime, start, end = imageFilters(request.args)
+
+    # the limit is checked before the experiment is listed, which is work in itself
+    with exports_lock:
+        if exports >= max_exports:
+            abort(503)
+        exports += 1
+    def finished():
+        global exports
+        with exports_lock:
+            exports -= 1
+    try:
+        entries, unconverted = zipEntries(zip_dir, exp_dir, plate, daytime, start, end)
+        archive = zipstream.ZipStream(entries)
+        response = Response(archive, mimetype='application/zip',
+                            headers={'Content-Length': str(archive.length()),
+                                     'Content-Disposition': 'attachment; filename="%s.zip"' % exp_dir,
+                                     'X-Unconverted-Images': str(unconverted)})
+    except BaseException:
+        finished()
+        raise
+    response.call_on_close(finished)
+    return response
+
+
+def zipEntries(zip_dir, exp_dir, plate=None, daytime=None, start=None, end=None):
+    '''returns the zip entries for the selected images of an experiment, and the number of
+       selected images that are left out as they are still in raw archives'''
+    # adds any images missing from the manifest, so that the download has every image on disk
+    manifest.build(zip_dir)
+    conn = manifest.connect(zip_dir)
+    entries = []
+    unconverted = 0
+    try:
+        for row in manifest.select(conn, plate, daytime, start, end):
+            path = os.path.join(zip_dir, row['path'])
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # still in a raw archive
+                unconverted += 1
+                continue
+            # the crc in the manifest saves reading each file twice, if the file is unchanged
+            crc = row['crc32'] if row['size'] == st.st_size else None
+            entries.append(zipstream.Entry(path, exp_dir + '/' + row['path'], crc, st))
+    finally:
+        conn.close()
+    if (plate, daytime, start, end) == (None,) * 4 and not (experimenter.running and os.path.abspath(experimenter.dir) == zip_dir):
+        # the manifest is only included while it is not being written to
+        path = os.path.join(zip_dir, manifest.filename)
+        entries.append(zipstream.Entry(path, exp_dir + '/' + manifest.filename))
+    if unconverted:
+        # frames in raw archives are not included, which is said in a note at the top of the archive
+        note = ("%d of the selected images are still in raw frame archives, and are not included in this download.\n"
+                "They are converted between cycles while raw mode experiments run, or can be converted using:\n"
+                "spiro --convert-raw '%s'\n" % (unconverted, zip_dir))
+        entries.insert(0, zipstream.Entry(None, exp_dir + '/NOT-INCLUDED.txt', data=note.encode()))
+    return entries, unconverted
 
 
 @app.route('/delete/<exp_dir>/', methods=['GET', 'POST'])
@@ -577,6 +703,9 @@ def delete_dir(exp_dir):
             flash('Cannot remove active experiment directory. Please stop experiment first.')
             return redirect(url_for('file_browser'))
         if verify_dir(del_dir):
+            # archives left open would keep their disk space in use, and be written to by the
+            # next experiment in a directory of the same name
+            rawarchive.closeDir(del_dir)
             shutil.rmtree(del_dir)
             flash(f'Directory {exp_dir} deleted.')
             return redirect(url_for('file_browser'))
@@ -592,18 +721,57 @@ def dir_browser(dir):
     if not verify_dir(dir):
         abort(404)
 
-    files = {}
-    for plate in ['plate' + str(i+1) for i in range(4)]:
-        plate_files = []
-        for entry in os.scandir(os.path.join(dir, plate)):
-            if entry.is_file() and os.path.dirname(entry.path).startswith(dir) and not entry.name.startswith('.') and \
-                    os.path.basename(os.path.dirname(entry.path)).startswith('plate'):
-                plate_files.append({'path': os.path.basename(os.path.dirname(entry.path)) + '/' + entry.name,
-                                    'name': entry.name})
-        files[plate] = sorted(plate_files, key=lambda x: x['name'])
-
-    return render_template('browse.html', dir=check_dir, files=files, 
+    # the images are fetched page by page from browse_images() as the user scrolls
+    return render_template('browse.html', dir=check_dir, args=request.args,
                            name=cfg.get('name'), running=experimenter.running)
+
+
+def imageFilters(args):
+    '''returns the plate, day or night, and start and end times given in the query string'''
+    try:
+        plate = int(args['plate']) if args.get('plate') else None
+    except ValueError:
+        abort(400)
+    if plate is not None and not 1 <= plate <= 4:
+        abort(400)
+    daytime = {'day': True, 'night': False}.get(args.get('time'))
+    return plate, daytime, parseTime(args.get('start')), parseTime(args.get('end'))
+
+
+@app.route('/browse/<dir>/images')
+def browse_images(dir):
+    '''one page of the images of an experiment, as json. query parameters: plate (1-4), time
+       (day or night), start and end (unix or iso time), order (asc or desc), limit, and cursor,
+       which is the "next" value of the previous page.'''
+    dir = os.path.join(os.path.expanduser('~'), dir)
+    if not verify_dir(dir) or not isExperiment(dir):
+        abort(404)
+    args = request.args
+    plate, daytime, start, end = imageFilters(args)
+    try:
+        limit = int(args.get('limit', 100))
+    except ValueError:
+        abort(400)
+
+    # experiments from before manifests were written get one on their first visit, and images
+    # without a record are added to it whenever the plate directories have changed
+    manifest.build(dir)
+    conn = manifest.connect(dir)
+    try:
+        images, cursor = manifest.page(conn, plate, daytime, start, end,
+                                       args.get('order') == 'desc', args.get('cursor'), limit)
+    except (ValueError, TypeError):
+        # a mangled cursor
+        abort(400)
+    finally:
+        conn.close()
+    for image in images:
+        # the thumbnails of the page are made in the background, if the browser does not ask first
+        thumbs.add(os.path.join(dir, image['path']))
+        image['name'] = os.path.basename(image['path'])
+        image['daytime'] = bool(image['daytime'])
+        image['archived'] = bool(image['archived'])
+    return jsonify({'images': images, 'next': cursor})
     
 
 @app.route('/view/<dir>/<plate>/<file>')
@@ -614,12 +782,63 @@ def view_file(dir, plate, file):
         return redirect(url_for('file_browser'))
 
     try:
-        with open(file, 'rb') as f:
-            img_data = f.read()
+        st = os.stat(file)
     except FileNotFoundError:
+        # the image may still be waiting for conversion in a raw frame archive
+        found = rawarchive.lookup(file)
+        if not found:
+            abort(404)
+        return archivedResponse(*found)
+
+    return httpcache.sendFile(file, mimetypes.guess_type(file)[0] or 'application/octet-stream', view_cache, st)
+
+
+@app.route('/thumb/<dir>/<plate>/<file>')
+def thumbnail(dir, plate, file):
+    '''a downscaled image, of at most ?size= pixels on its longer side (see thumbs.sizes)'''
+    file = os.path.abspath(os.path.join(os.path.expanduser('~'), dir, plate, file))
+    if not verify_dir(dir) or not os.path.dirname(file).startswith(os.path.join(os.path.expanduser('~'), dir, plate)):
         abort(404)
-    
-    return Response(img_data, mimetype='image/png')
+    try:
+        size = int(request.args.get('size', thumbs.default_size))
+    except ValueError:
+        abort(400)
+    if size not in thumbs.sizes:
+        abort(400)
+    fmt = 'webp' if thumbs.default_format == 'webp' and request.accept_mimetypes['image/webp'] else 'jpeg'
+
+    try:
+        thumb = thumbs.get(file, size, fmt)
+    except OSError:
+        # no such image, or a file that is not an image (PIL.UnidentifiedImageError is an OSError)
+        abort(404)
+    response = httpcache.sendFile(thumb, 'image/' + fmt, view_cache)
+    response.vary.add('Accept')
+    return response
+
+
+def archivedImage(archive, i):
+    '''encodes a frame that has not yet been converted from its raw archive, using fast compression'''
+    buf = io.BytesIO()
+    rawarchive.encode(archive, i, buf, 'png', 1)
+    return buf.getvalue()
+
+
+def archivedResponse(archive, i):
+    '''responds with a frame from a raw archive, as found by rawarchive.lookup(), and closes the
+       archive. the frames in an archive are never rewritten, so the etag need only name the
+       archive and the frame.'''
+    with archive:
+        etag = 'raw-%x-%d' % (archive.key[1], i)
+        response = httpcache.notModified(etag)
+        if response is None:
+            response = httpcache.headers(Response(archivedImage(archive, i), mimetype='image/png'), etag)
+        return response
+
+
+def isExperiment(path):
+    '''returns true if a directory has the plate directories of an experiment'''
+    return all(os.path.isdir(os.path.join(path, 'plate' + str(i + 1))) for i in range(4))
 
 
 def verify_dir(check_dir):
@@ -634,16 +853,14 @@ def verify_dir(check_dir):
 
 @app.route('/log')
 def get_log():
-    p = subprocess.Popen(['/bin/journalctl', '--user-unit=spiro', '-n', '1000'], stdout=subprocess.PIPE)
-    return Response(stream_popen(p), mimetype='text/plain')
+    '''the log, from the in-process log buffer. see logview.py for the query parameters.'''
+    return logview.response(request)
 
 
-def stream_popen(p):
-    '''generator for sending STDOUT to a web client'''
-    data = p.stdout.read(128*1024)
-    while data:
-        yield data
-        data = p.stdout.read(128*1024)
+@app.route('/log/live')
+def live_log():
+    return render_template('log.html', name=cfg.get('name'), running=experimenter.running,
+                           level=request.args.get('level', ''), component=request.args.get('component', ''))
 
 
 @app.route('/debug/<value>')
@@ -693,7 +910,8 @@ def set_hotspot(value):
     return redirect(url_for('settings'))
 
 
-liveoutput = StreamingOutput()
+liveoutput = FrameStore()
+broadcaster = Broadcaster(liveoutput)
 nightstill = io.BytesIO()
 daystill = io.BytesIO()
 zoomer = ZoomObject()
@@ -701,6 +919,7 @@ cfg = Config()
 lock = Lock()
 
 experimenter = None
+settler = None
 nightshutter = None
 dayshutter = None
 camera = None
@@ -710,10 +929,11 @@ restarting = False
 livestream = False
 
 def start(cam, myhw):
-    global camera, hw, experimenter
+    global camera, hw, experimenter, settler
     camera = cam
     hw = myhw
     experimenter = Experimenter(hw=hw, cam=cam)
+    settler = SettleDetector(cam, cfg)
     experimenter.start()
     if cfg.get('secret') == '':
         secret = hashlib.sha1(os.urandom(16))
@@ -725,8 +945,10 @@ def start(cam, myhw):
             camera.rotation = 90
         setLive('on')
         #app.run(host="0.0.0.0", port=8080, debug=False)
-        # use a tcp timeout of 20 seconds to improve hanging behavior in live view
-        serve(app, listen="*:8080", threads=8, channel_timeout=20)
+        # use a tcp timeout of 20 seconds to improve hanging behavior in live view.
+        # a small output buffer per connection makes slow live view clients skip frames,
+        # instead of having them queued in the server.
+        serve(app, listen="*:8080", threads=8, channel_timeout=20, outbuf_high_watermark=512*1024)
     finally:
         stop()
 
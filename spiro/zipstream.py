@@ -0,0 +1,186 @@
+# zipstream.py -
+#   writes zip archives of stored (uncompressed) files as a stream, straight from disk,
+#   for downloading experiments. the images are already compressed, so they are not
+#   compressed again. the length of the archive is known before it is written.
+#
+
+import os
+import time
+import zlib
+import struct
+
+# files are read and sent in blocks of this size
+block_size = 256 * 1024
+# sizes and offsets from this value up, and this many entries, need zip64 records
+zip64_limit = 0xFFFFFFFF
+max_entries = 0xFFFF
+# stand in for the values in zip64 records
+FULL32 = 0xFFFFFFFF
+FULL16 = 0xFFFF
+
+local_header = struct.Struct('<IHHHHHIIIHH')
+central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+descriptor = struct.Struct('<IIII')
+descriptor64 = struct.Struct('<IIQQ')
+end_record = struct.Struct('<IHHHHIIH')
+end_record64 = struct.Struct('<IQHHIIQQQQ')
+end_locator64 = struct.Struct('<IIQI')
+
+# general purpose flags: sizes and crc follow the data; the file name is utf-8
+FLAG_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def dosTime(mtime):
+    t = time.localtime(max(mtime, 315532800))
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class Entry(object):
+    '''a file to add to an archive. crc is its crc-32, if known; otherwise it is computed as the
+       file is sent, and written after the file data. instead of a path, the contents of the
+       file may be given as data.'''
+    def __init__(self, path, name, crc=None, st=None, data=None):
+        self.path = path
+        self.name = name.encode('utf-8')
+        self.data = data
+        if data is not None:
+            crc = zlib.crc32(data)
+        self.crc = crc
+        # the crc is computed while the file is sent, and written after it
+        self.streamed = crc is None
+        if data is not None:
+            self.size = len(data)
+            self.mtime = time.time()
+        else:
+            st = st or os.stat(path)
+            self.size = st.st_size
+            self.mtime = st.st_mtime
+        self.offset = None
+
+
+    @property
+    def zip64(self):
+        return self.size >= zip64_limit
+
+
+    @property
+    def flags(self):
+        return FLAG_UTF8 | (FLAG_DESCRIPTOR if self.streamed else 0)
+
+
+    def localHeader(self):
+        '''the header before the file data. for streamed entries, crc and sizes are zero here,
+           and follow the data in a descriptor.'''
+        known = not self.streamed
+        extra = b''
+        size = self.size if known else 0
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, size, size)
+            size = FULL32
+        mtime, mdate = dosTime(self.mtime)
+        return local_header.pack(0x04034b50, 45 if self.zip64 else 20, self.flags, 0, mtime, mdate,
+                                 self.crc if known else 0, size, size, len(self.name), len(extra)) + self.name + extra
+
+
+    def descriptor(self):
+        if not self.streamed:
+            return b''
+        if self.zip64:
+            return descriptor64.pack(0x08074b50, self.crc, self.size, self.size)
+        return descriptor.pack(0x08074b50, self.crc, self.size, self.size)
+
+
+    def descriptorSize(self):
+        if not self.streamed:
+            return 0
+        return descriptor64.size if self.zip64 else descriptor.size
+
+
+    def centralHeader(self):
+        fields = []
+        size = self.size
+        offset = self.offset
+        if self.zip64:
+            fields += [self.size, self.size]
+            size = FULL32
+        if self.offset >= zip64_limit:
+            fields.append(self.offset)
+            offset = FULL32
+        extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields) if fields else b''
+        mtime, mdate = dosTime(self.mtime)
+        # made by unix, so that the file mode is used
+        return central_header.pack(0x02014b50, (3 << 8) | 45, 45 if fields else 20, self.flags, 0, mtime, mdate,
+                                   self.crc or 0, size, size, len(self.name), len(extra), 0, 0, 0,
+                                   (0o100644 << 16), offset) + self.name + extra
+
+
+class ZipStream(object):
+    '''a zip archive of the given entries, sent by iterating over it'''
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+
+    def length(self):
+        '''returns the length of the archive in bytes'''
+        offset = 0
+        central = 0
+        for e in self.entries:
+            e.offset = offset
+            offset += len(e.localHeader()) + e.size + e.descriptorSize()
+            central += len(e.centralHeader())
+        return offset + central + self.endLength(offset, central)
+
+
+    def endLength(self, offset, central):
+        if self.needsZip64(offset, central):
+            return end_record64.size + end_locator64.size + end_record.size
+        return end_record.size
+
+
+    def needsZip64(self, offset, central):
+        return len(self.entries) >= max_entries or offset >= zip64_limit or central >= zip64_limit
+
+
+    def __iter__(self):
+        offset = 0
+        for e in self.entries:
+            e.offset = offset
+            header = e.localHeader()
+            yield header
+            offset += len(header)
+            if e.data is not None:
+                yield e.data
+                offset += e.size
+                continue
+            crc = 0
+            sent = 0
+            with open(e.path, 'rb') as f:
+                while sent < e.size:
+                    data = f.read(min(block_size, e.size - sent))
+                    if not data:
+                        raise IOError('%s is shorter than when the download started' % e.path)
+                    if e.streamed:
+                        crc = zlib.crc32(data, crc)
+                    sent += len(data)
+                    yield data
+            offset += sent
+            if e.streamed:
+                e.crc = crc
+                data = e.descriptor()
+                offset += len(data)
+                yield data
+
+        start = offset
+        central = b''.join(e.centralHeader() for e in self.entries)
+        yield central
+        yield self.end(start, len(central))
+
+
+    def end(self, start, central):
+        n = len(self.entries)
+        if not self.needsZip64(start, central):
+            return end_record.pack(0x06054b50, 0, 0, n, n, central, start, 0)
+        return end_record64.pack(0x06064b50, end_record64.size - 12, (3 << 8) | 45, 45, 0, 0, n, n, central, start) + \
+            end_locator64.pack(0x07064b50, 0, start + central, 1) + \
+            end_record.pack(0x06054b50, 0, 0, FULL16, FULL16, FULL32, FULL32, 0)